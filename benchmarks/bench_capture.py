@@ -0,0 +1,55 @@
+''' HW50 capture replay smoke run and benchmark
+
+    Writes a synthetic capture of request/response pairs with some junk,
+    and replays it with python -m hatt.capture, so the replay tool is run
+    the same way as on real captures.
+
+    python -m benchmarks.bench_capture [--pairs N]
+'''
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+from hatt import capture
+from hatt.hw50 import (
+    GET_RQ, GET_RS, STATUS_POWER, LAMP_TIMER, encode_hw50frame,
+)
+
+
+def write_capture(path, pairs, seed=1):
+    rnd = random.Random(seed)
+    writer = capture.CaptureWriter(path)
+    for i in range(pairs):
+        item = (STATUS_POWER, LAMP_TIMER)[i % 2]
+        writer.write(capture.TX, encode_hw50frame(item, GET_RQ, 0))
+        frame = encode_hw50frame(item, GET_RS, rnd.randrange(0x10000))
+        if rnd.random() < 0.1:
+            frame = bytes(rnd.getrandbits(8) for _ in range(3)) + frame
+        # The response arrives split in two reads
+        split = rnd.randrange(1, len(frame))
+        writer.write(capture.RX, frame[:split])
+        writer.write(capture.RX, frame[split:])
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HW50 capture replay smoke run")
+    parser.add_argument('--pairs', type=int, default=10000)
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'hw50.cap')
+        write_capture(path, opts.pairs)
+        result = subprocess.run([sys.executable, '-m', 'hatt.capture', path],
+                                capture_output=True, text=True)
+    print(result.stdout, end='')
+    if result.returncode or f"{opts.pairs} frames" not in result.stdout:
+        print(result.stderr, end='', file=sys.stderr)
+        sys.exit("Capture replay failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+''' Frames per second per core of the sACN and Art-Net outputs
+
+    python -m benchmarks.bench_dmxnet [--universes N ...] [--frames N]
+
+The senders send to a local receiver stand-in. The first pass runs the DMX
+scheduler with fades on all universes for a second and checks what the
+receiver got. The second pass sends full frames as fast as possible, and
+compares the preallocated packets with building each packet anew.
+'''
+import argparse
+import asyncio
+import socket
+import struct
+import time
+
+from hatt import dmx
+from hatt import dmxnet
+
+
+def naive_sacn(sender, universe, sequence, data):
+    ''' Build a sACN packet the straightforward way, for comparison '''
+    length = dmxnet.SACN_HEADER + len(data)
+    return b''.join((
+        b'\x00\x10\x00\x00ASC-E1.17\x00\x00\x00',
+        struct.pack('!HI', 0x7000 | (length - 16), 4), sender.cid,
+        struct.pack('!HI', 0x7000 | (length - 38), 2), sender.name.encode().ljust(64, b'\x00'),
+        struct.pack('!BHBBH', sender.priority, 0, sequence, 0, universe),
+        struct.pack('!HBBHHH', 0x7000 | (length - 115), 2, 0xA1, 0, 1, len(data) + 1),
+        b'\x00', bytes(data),
+    ))
+
+
+def naive_artnet(sender, universe, sequence, data):
+    return b''.join((
+        b'Art-Net\x00', struct.pack('<H', dmxnet.ARTNET_OPDMX),
+        struct.pack('!HBBBBH', dmxnet.ARTNET_VERSION, sequence, 0,
+                    universe & 0xFF, universe >> 8, len(data)),
+        bytes(data),
+    ))
+
+
+NAIVE = {'sacn': naive_sacn, 'artnet': naive_artnet}
+
+
+async def check(output, nuniverses):
+    ''' Run the scheduler with fades on all universes, and compare the
+        frames with what the receiver got
+    '''
+    receiver = await dmxnet.Receiver().start(output, '127.0.0.1', 0)
+    sender = dmxnet.SENDERS[output]('127.0.0.1', receiver.address[1])
+    universes = [dmx.Universe(sender, u) for u in range(1, nuniverses + 1)]
+    for uni in universes:
+        for address in range(0, dmx.DMX_SIZE, 4):
+            uni.fade(address, [255, 128, 64, 32], 1)
+        uni.start()
+
+    await asyncio.sleep(1.2)
+    for uni in universes:
+        uni.task.cancel()
+    await asyncio.sleep(0.05)
+
+    ok = all(receiver.universes.get(u.universe) == bytes(u.frame) for u in universes)
+    print(f"{output}: {nuniverses} universe(s) at {dmx.DEFAULT_FPS} fps for 1.2 s: "
+          f"{sender.frames} frames sent, {receiver.frames} received, "
+          f"{receiver.lost} lost, data {'ok' if ok else 'MISMATCH'}")
+    sender.close()
+    receiver.close()
+
+
+def bench(output, nuniverses, frames):
+    ''' Send frames as fast as possible to a socket that isn't read. The
+        kernel drops what doesn't fit, which doesn't cost the sender.
+    '''
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    port = sink.getsockname()[1]
+
+    sender = dmxnet.SENDERS[output]('127.0.0.1', port)
+    frame = bytearray(dmx.DMX_SIZE)
+    view = memoryview(frame)
+    universes = list(range(1, nuniverses + 1))
+
+    t0 = time.process_time()
+    for i in range(frames // nuniverses):
+        frame[0] = i & 0xFF
+        for u in universes:
+            sender.send_dmx(u, view)
+    patched = time.process_time() - t0
+    sent = frames // nuniverses * nuniverses
+
+    naive = NAIVE[output]
+    sock = sender.sock
+    t0 = time.process_time()
+    for i in range(frames // nuniverses):
+        frame[0] = i & 0xFF
+        for u in universes:
+            sock.sendto(naive(sender, u, i & 0xFF, frame), ('127.0.0.1', port))
+    built = time.process_time() - t0
+
+    print(f"{output}: {nuniverses} universe(s), {sent} frames of {dmx.DMX_SIZE} channels")
+    print(f"    preallocated {sent / patched:9.0f} frames/s per core, "
+          f"{patched / sent * 1e6:.2f} us per frame")
+    print(f"    built anew   {sent / built:9.0f} frames/s per core, "
+          f"{built / sent * 1e6:.2f} us per frame")
+    print(f"    {sent / patched / dmx.DEFAULT_FPS:.0f} universes at {dmx.DEFAULT_FPS} fps per core")
+    sender.close()
+    sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sACN and Art-Net output benchmark")
+    parser.add_argument('--outputs', nargs='*', choices=dmxnet.SENDERS, default=list(dmxnet.SENDERS))
+    parser.add_argument('--universes', type=int, nargs='*', default=[1, 16])
+    parser.add_argument('--frames', type=int, default=200000)
+    opts = parser.parse_args()
+
+    for output in opts.outputs:
+        for nuniverses in opts.universes:
+            asyncio.run(check(output, nuniverses))
+            bench(output, nuniverses, opts.frames)
+
+
+if __name__ == '__main__':
+    main()
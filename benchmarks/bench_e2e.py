@@ -0,0 +1,389 @@
+''' End-to-end benchmark of the devices over MQTT
+
+    Runs Hw50Hatt against Hw50Emulator and OlaHatt against the fake olad,
+    connected to a local MQTT broker. A benchmark client sends commands to
+    the devices and waits for the resulting state messages. Each device has
+    one command outstanding at a time, and all devices run concurrently.
+
+    It measures the latency from command to state, commands per second and
+    the CPU use of the process, which includes the benchmark client and the
+    fake olad. The broker runs in a separate process.
+
+    python -m benchmarks.bench_e2e [--devices N ...] [--json FILE]
+                                   [--baseline FILE [--tolerance X]]
+                                   [--flood N [--coalesce]]
+
+    --flood sends a burst of N commands to every device, and measures the
+    time until the state of the last command is reported. --coalesce
+    enables the coalescing of the commands in the devices.
+
+    --json writes the results as JSON. --baseline compares the results with
+    the JSON results of an earlier run, and exits with status 1 if any of
+    them are worse than the tolerance.
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+import asyncio_mqtt as mqtt
+
+from hatt import hatt, hw50, hw50emu, ola, olad, state
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Results compared with the baseline, and if higher is better
+COMPARED = (
+    ('latency_ms_median', False),
+    ('latency_ms_p95', False),
+    ('commands_per_sec', True),
+    ('cpu_ms_per_command', False),
+)
+
+
+class Target:
+    ''' A device under test '''
+
+    def __init__(self, device, config_topic, command_topic, state_topic):
+        self.device = device
+        self.config_topic = config_topic
+        self.command_topic = command_topic
+        self.state_topic = state_topic
+
+
+def device_conf(module, topic, i):
+    return {
+        'id': f"{module}{i}",
+        'module': module,
+        'name': f"Bench {module} {i}",
+        'unique_id': f"bench_{module}{i}",
+        'topic': topic,
+        'device': {'identifiers': [f"bench_{module}{i}"]},
+        'status_interval': 60,
+        'retained_timeout': 0.1,
+    }
+
+
+class Hw50Bench:
+    ''' Switch the projectors on and off '''
+    name = 'hw50'
+
+    def __init__(self, opts):
+        self.delay = opts.hw50_delay
+
+    def create(self, hub, prefix, i):
+        conf = device_conf('hw50', f"{prefix}/hw50_{i}", i)
+        protocol = hw50.Hw50()
+        hw50emu.Hw50Emulator(protocol, delay=self.delay, transition=self.delay)
+        device = hw50.Hw50Hatt(conf, hub, protocol)
+        return Target(device, device.config_topic, device.command_topic, device.state_topic)
+
+    @staticmethod
+    def command(k):
+        value = 'ON' if k % 2 == 0 else 'OFF'
+        return value.encode(), lambda s: s['state'] == value
+
+
+class OlaBench:
+    ''' Set the brightness of one RGBW fixture per device '''
+    name = 'ola'
+
+    def __init__(self, opts):
+        self.olad = None
+
+    async def start(self):
+        self.olad = await olad.FakeOlad().start('127.0.0.1', 0)
+        return self.olad.server.sockets[0].getsockname()[1]
+
+    def create(self, hub, prefix, i):
+        conf = device_conf('ola', f"{prefix}/ola_{i}", i)
+        conf['olad_host'] = '127.0.0.1'
+        conf['olad_port'] = self.port
+        conf['fixtures'] = {'light': {
+            'universe': i // 128, 'address': i % 128 * 4 + 1, 'channels': 'rgbw',
+        }}
+        device = ola.OlaHatt(conf, hub)
+        fixture, = device.fixtures.values()
+        return Target(device, fixture.config_topic, fixture.command_topic, fixture.state_topic)
+
+    @staticmethod
+    def command(k):
+        brightness = k % 255 + 1
+        payload = state.dumps({'state': 'ON', 'brightness': brightness})
+        return payload, lambda s: s['brightness'] == brightness
+
+
+class Client:
+    ''' The benchmark client, standing in for Home Assistant '''
+
+    def __init__(self, host, port):
+        self.mqtt = mqtt.Client(host, port)
+        self.waiters = {}
+        self.configs = set()
+        self.configs_seen = asyncio.Event()
+        self.task = None
+
+    async def start(self, prefix):
+        await self.mqtt.connect()
+        self.messages = self.mqtt.unfiltered_messages()
+        messages = await self.messages.__aenter__()
+        await self.mqtt.subscribe(f"{prefix}/#")
+        self.task = asyncio.create_task(self.receive(messages))
+
+    async def stop(self):
+        await hatt.cancel_task(self.task)
+        await self.messages.__aexit__(None, None, None)
+        await self.mqtt.disconnect()
+
+    async def receive(self, messages):
+        async for message in messages:
+            topic = message.topic
+            if topic in self.configs:
+                self.configs.discard(topic)
+                if not self.configs:
+                    self.configs_seen.set()
+            waiter = self.waiters.get(topic)
+            if waiter and message.payload:
+                predicate, future = waiter
+                if not future.done() and predicate(state.loads(message.payload)):
+                    future.set_result(None)
+
+    async def wait_configs(self, topics, timeout):
+        self.configs = set(topics)
+        self.configs_seen.clear()
+        await asyncio.wait_for(self.configs_seen.wait(), timeout)
+
+    async def drive(self, target, command, commands, latencies, timeout):
+        ''' Send commands to the target one at a time '''
+        loop = asyncio.get_running_loop()
+        for k in range(commands):
+            payload, predicate = command(k)
+            future = loop.create_future()
+            self.waiters[target.state_topic] = (predicate, future)
+            t0 = time.perf_counter()
+            await self.mqtt.publish(target.command_topic, payload)
+            await asyncio.wait_for(future, timeout)
+            latencies.append(time.perf_counter() - t0)
+
+    async def flood(self, target, command, commands, times, timeout):
+        ''' Send all commands at once, and wait for the state of the last '''
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[target.state_topic] = (command(commands - 1)[1], future)
+        t0 = time.perf_counter()
+        for k in range(commands):
+            await self.mqtt.publish(target.command_topic, command(k)[0])
+        await asyncio.wait_for(future, timeout)
+        times.append(time.perf_counter() - t0)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[round(p * (len(values) - 1))]
+
+
+async def bench(client, bench, broker, run, ndevices, commands, opts):
+    prefix = f"bench/{run}"
+    hub = hatt.MqttHub({
+        'name': f"bench-{run}",
+        'broker': broker[0],
+        'port': broker[1],
+        'reconnect_interval': 1,
+        'topic': f"{prefix}/hub",
+    })
+    targets = [bench.create(hub, prefix, i) for i in range(ndevices)]
+    for target in targets:
+        target.device.conf['coalesce'] = opts.coalesce
+
+    # Start the devices, and wait until they have published their configs
+    t0 = time.perf_counter()
+    tasks = [asyncio.create_task(t.device.main()) for t in targets]
+    hub_task = asyncio.create_task(hub.main())
+    try:
+        await client.wait_configs([t.config_topic for t in targets], opts.timeout)
+        startup = time.perf_counter() - t0
+
+        # Idle CPU use
+        await asyncio.sleep(0.2)
+        cpu0 = time.process_time()
+        await asyncio.sleep(opts.idle)
+        idle_cpu = time.process_time() - cpu0
+
+        # Closed loop load
+        latencies = []
+        cpu0 = time.process_time()
+        t0 = time.perf_counter()
+        await asyncio.gather(*[
+            client.drive(t, bench.command, commands, latencies, opts.timeout)
+            for t in targets
+        ])
+        elapsed = time.perf_counter() - t0
+        cpu = time.process_time() - cpu0
+
+        # Command floods
+        floods = []
+        if opts.flood:
+            await asyncio.gather(*[
+                client.flood(t, bench.command, opts.flood, floods, opts.timeout)
+                for t in targets
+            ])
+
+    finally:
+        for task in tasks:
+            await hatt.cancel_task(task)
+        await hatt.cancel_task(hub_task)
+
+    total = len(latencies)
+    result = {
+        'module': bench.name,
+        'devices': ndevices,
+        'commands': total,
+        'startup_s': round(startup, 4),
+        'latency_ms_min': round(min(latencies) * 1000, 3),
+        'latency_ms_median': round(percentile(latencies, 0.5) * 1000, 3),
+        'latency_ms_p95': round(percentile(latencies, 0.95) * 1000, 3),
+        'latency_ms_max': round(max(latencies) * 1000, 3),
+        'commands_per_sec': round(total / elapsed, 2),
+        'cpu_percent': round(cpu / elapsed * 100, 2),
+        'cpu_ms_per_command': round(cpu / total * 1000, 4),
+        'idle_cpu_percent_per_device': round(idle_cpu / opts.idle / ndevices * 100, 4),
+    }
+    if floods:
+        result['flood_commands'] = opts.flood
+        result['flood_ms_median'] = round(percentile(floods, 0.5) * 1000, 3)
+        result['flood_ms_max'] = round(max(floods) * 1000, 3)
+        result['coalesced'] = sum(t.device.dispatcher.coalesced for t in targets)
+    print(f"{bench.name}: {ndevices} device(s), {total} commands")
+    print(f"    latency min/median/p95/max {result['latency_ms_min']:.1f}/"
+          f"{result['latency_ms_median']:.1f}/{result['latency_ms_p95']:.1f}/"
+          f"{result['latency_ms_max']:.1f} ms")
+    print(f"    {result['commands_per_sec']:.1f} commands/s, "
+          f"{result['cpu_ms_per_command']:.3f} ms CPU per command, "
+          f"{result['cpu_percent']:.1f} % CPU")
+    print(f"    startup {startup:.3f} s, idle "
+          f"{result['idle_cpu_percent_per_device']:.3f} % CPU per device")
+    if floods:
+        print(f"    flood of {opts.flood} commands median/max {result['flood_ms_median']:.1f}/"
+              f"{result['flood_ms_max']:.1f} ms, {result['coalesced']} coalesced")
+    return result
+
+
+async def start_broker():
+    ''' Start the broker in a separate process. Returns the process and port '''
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'benchmarks.mqtt_broker', '--port', '0',
+        cwd=ROOT, stdout=asyncio.subprocess.PIPE,
+    )
+    port = int(await proc.stdout.readline())
+    return proc, port
+
+
+async def amain(opts):
+    proc = None
+    if opts.broker:
+        host, _, port = opts.broker.rpartition(':')
+        broker = (host, int(port))
+    else:
+        proc, port = await start_broker()
+        broker = ('127.0.0.1', port)
+
+    client = Client(*broker)
+    await client.start('bench')
+
+    results = []
+    try:
+        run = 0
+        for module in opts.modules:
+            if module == 'hw50':
+                b, commands = Hw50Bench(opts), opts.hw50_commands
+            else:
+                b, commands = OlaBench(opts), opts.commands
+                b.port = await b.start()
+            for ndevices in opts.devices:
+                run += 1
+                results.append(await bench(client, b, broker, run, ndevices, commands, opts))
+    finally:
+        await client.stop()
+        if proc:
+            proc.terminate()
+            await proc.wait()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    ''' Return the results which are worse than the baseline by more than
+        the tolerance
+    '''
+    base = {(r['module'], r['devices']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        ref = base.get((result['module'], result['devices']))
+        if not ref:
+            continue
+        for key, higher_is_better in COMPARED:
+            value, limit = result[key], ref[key]
+            if higher_is_better:
+                worse = value < limit * (1 - tolerance)
+            else:
+                worse = value > limit * (1 + tolerance)
+            if worse:
+                regressions.append(
+                    f"{result['module']} {result['devices']} device(s): "
+                    f"{key} {value} vs baseline {limit}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark over MQTT")
+    parser.add_argument('--modules', nargs='*', default=['ola', 'hw50'], choices=['ola', 'hw50'])
+    parser.add_argument('--devices', type=int, nargs='*', default=[1, 10, 50])
+    parser.add_argument('--commands', type=int, default=200,
+                        help='Commands per ola device. Default 200')
+    parser.add_argument('--hw50-commands', type=int, default=4,
+                        help='Commands per hw50 device. Each takes about one second. Default 4')
+    parser.add_argument('--hw50-delay', type=float, default=0.02,
+                        help='Reply delay of the emulated projector. Default 0.02')
+    parser.add_argument('--flood', type=int, default=0, metavar='N',
+                        help='Send bursts of N commands to each device')
+    parser.add_argument('--coalesce', action='store_true', help='Coalesce the commands')
+    parser.add_argument('--idle', type=float, default=1.0,
+                        help='Seconds to measure the idle CPU use. Default 1')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--broker', metavar='HOST:PORT', help='Use this broker instead of the local one')
+    parser.add_argument('--json', metavar='FILE', help='Write the results to FILE')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare with the results in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative regression from the baseline. Default 0.2')
+    parser.add_argument('--log-level', default='WARNING')
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=opts.log_level.upper())
+    state.set_json_backend()
+
+    results = asyncio.run(amain(opts))
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump({
+                'benchmark': 'e2e',
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            regressions = compare(results, json.load(f), opts.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
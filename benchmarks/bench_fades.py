@@ -0,0 +1,57 @@
+''' CPU cost of rendering simultaneous DMX fades
+
+    python -m benchmarks.bench_fades [--fades N] [--channels N]
+'''
+import argparse
+import asyncio
+import time
+
+from hatt import dmx
+
+
+async def bench(nfades, channels, ticks):
+    universe = dmx.Universe(None, 0)
+    loop = asyncio.get_running_loop()
+    fixtures = min(nfades, dmx.DMX_SIZE // channels)
+
+    # Start the fades. More fades than fit in one universe are spread over
+    # several universes rendered in the same tick.
+    universes = [universe]
+    while len(universes) * fixtures < nfades:
+        universes.append(dmx.Universe(None, len(universes)))
+    n = 0
+    for uni in universes:
+        for i in range(fixtures):
+            if n == nfades:
+                break
+            uni.fade(i * channels, [255] * channels, 3600)
+            n += 1
+
+    # Render ticks as fast as possible
+    now = loop.time()
+    t0 = time.perf_counter()
+    for tick in range(ticks):
+        for uni in universes:
+            uni.render(now + tick / dmx.DEFAULT_FPS)
+    elapsed = time.perf_counter() - t0
+
+    per_tick = elapsed / ticks
+    print(f"{nfades} fades x {channels} channels, {len(universes)} universe(s)")
+    print(f"    {per_tick * 1e6:.1f} us per tick, "
+          f"{per_tick / nfades * 1e6:.2f} us per fade")
+    print(f"    {per_tick * dmx.DEFAULT_FPS * 100:.2f} % CPU at {dmx.DEFAULT_FPS} fps")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DMX fade benchmark")
+    parser.add_argument('--fades', type=int, nargs='*', default=[1, 10, 100, 128, 512])
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--ticks', type=int, default=1000)
+    opts = parser.parse_args()
+
+    for nfades in opts.fades:
+        asyncio.run(bench(nfades, opts.channels, opts.ticks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+''' HW50 codec micro-benchmarks
+
+    Compares the table-driven codec with the previous byte by byte codec.
+
+    python -m benchmarks.bench_hw50_codec [--number N]
+'''
+import argparse
+import timeit
+
+from hatt import hw50
+from hatt.hw50 import (
+    FRAMESIZE, SOF, EOF, GET_RQ, GET_RS, SET_RQ, STATUS_POWER, LAMP_TIMER,
+    IR_PWRON, FrameError,
+)
+
+
+# -- The previous codec --
+
+def legacy_dump(data):
+    msg = bytearray(data)
+    s = ' '.join(['%02x' %(x) for x in msg])
+    return "(%s) %s" %(len(data), s)
+
+
+def legacy_dumptext(data):
+    b = bytearray(data)
+    item = b[1]<<8 | b[2]
+    cmd = b[3]
+    data = b[4]<<8 | b[5]
+    s1 = hw50.TYPES.get(cmd, '???')
+    s2 = ''
+    s3 = hw50.ITEMS.get(item, '???')
+    if cmd == GET_RQ:
+        s2 = '%04x "%s"' %(item, s3)
+    elif cmd in (SET_RQ, GET_RS):
+        s2 = '%04x "%s" = %04x' %(item, s3, data)
+    elif cmd == hw50.ACK_RS:
+        s2 = hw50.RESPONSES.get(item, '???')
+    return s1 + ' ' + s2
+
+
+def legacy_decode(frame):
+    b = bytearray(frame)
+    if len(frame) != FRAMESIZE:
+        raise FrameError("Incomplete frame")
+    if b[0] != SOF:
+        raise FrameError("Wrong SOF field")
+    if b[7] != EOF:
+        raise FrameError("Wrong EOF field")
+    c = 0
+    for x in range(1, 6):
+        c |= b[x]
+    if b[6] != c:
+        raise FrameError("Checksum failure")
+    item = b[1]<<8 | b[2]
+    cmd = b[3]
+    data = b[4]<<8 | b[5]
+    hw50.check_response(item, cmd)
+    return (item, cmd, data)
+
+
+def legacy_encode(item, cmd, data):
+    b = bytearray(b"\x00" * FRAMESIZE)
+    b[0] = SOF
+    b[1] = (item&0xFF00)>>8
+    b[2] = (item&0xFF)
+    b[3] = cmd
+    b[4] = (data&0xFF00)>>8
+    b[5] = (data&0xFF)
+    c = 0
+    for x in range(1, 6):
+        c |= b[x]
+    b[6] = c
+    b[7] = EOF
+    return b
+
+
+def check():
+    ''' Verify that the codecs are equivalent '''
+    for item in range(0, 0x10000, 251):
+        for cmd in (SET_RQ, GET_RQ, GET_RS):
+            for data in range(0, 0x10000, 4099):
+                frame = hw50.encode_hw50frame(item, cmd, data)
+                assert frame == legacy_encode(item, cmd, data)
+                assert hw50.dump(frame) == legacy_dump(frame)
+                assert hw50.dumptext(frame) == legacy_dumptext(frame)
+                assert hw50.decode_hw50frame(frame, False) == (item, cmd, data)
+
+
+def bench(name, stmt, number, frames=1):
+    t = min(timeit.repeat(stmt, number=number, repeat=3))
+    print(f"    {name:24} {t / number / frames * 1e6:8.3f} us per frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HW50 codec benchmark")
+    parser.add_argument('--number', type=int, default=100000)
+    opts = parser.parse_args()
+    n = opts.number
+
+    check()
+
+    request = legacy_encode(STATUS_POWER, GET_RQ, 0)
+    response = bytes(legacy_encode(LAMP_TIMER, GET_RS, 1234))
+    batch = response * 16
+
+    print("encode")
+    bench("new, cached GET", lambda: hw50.encode_hw50frame(STATUS_POWER, GET_RQ, 0), n)
+    bench("new, cached IR", lambda: hw50.encode_hw50frame(IR_PWRON, SET_RQ, 0), n)
+    bench("new, uncached", lambda: hw50.encode_hw50frame(LAMP_TIMER, GET_RS, 1234), n)
+    bench("legacy", lambda: legacy_encode(STATUS_POWER, GET_RQ, 0), n)
+    print("decode")
+    bench("new", lambda: hw50.decode_hw50frame(response), n)
+    bench("new, batch of 16", lambda: hw50.decode_hw50frames(batch), n // 16, 16)
+    bench("legacy", lambda: legacy_decode(response), n)
+    print("dump")
+    bench("new", lambda: hw50.dump(request), n)
+    bench("legacy", lambda: legacy_dump(request), n)
+    print("dumptext")
+    bench("new", lambda: hw50.dumptext(request), n)
+    bench("legacy", lambda: legacy_dumptext(request), n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+''' HW50 frame parser benchmark and fuzz test
+
+    Compares Hw50Framer with the previous implementation of
+    Hw50.data_received, which rescanned the whole receive buffer for every
+    received chunk.
+
+    python -m benchmarks.bench_hw50_framer [--fuzz N]
+'''
+import argparse
+import random
+import time
+
+from hatt.hw50 import (
+    Hw50Framer, FrameError, FRAMESIZE, SOF, EOF, GET_RS, ACK_RS, ACK_OK,
+    STATUS_POWER, LAMP_TIMER, decode_hw50frame, encode_hw50frame,
+)
+
+
+class LegacyFramer:
+    ''' The previous parser in Hw50.data_received, without the printing '''
+
+    def __init__(self):
+        self.rxbuffer = bytearray()
+
+    @property
+    def buffer(self):
+        return self.rxbuffer
+
+    def feed(self, data):
+        self.rxbuffer += bytearray(data)
+        buf = self.rxbuffer
+        for x in range(0, len(buf)-FRAMESIZE+1):
+            if buf[x] == SOF and buf[x+FRAMESIZE-1] == EOF:
+                try:
+                    frame = buf[x:x+FRAMESIZE]
+                    item, cmd, data = decode_hw50frame(frame)
+                except FrameError:
+                    continue
+                self.rxbuffer = buf[x+FRAMESIZE:]
+                return [(item, cmd, data)]
+        return []
+
+
+FRAMES = [
+    (STATUS_POWER, GET_RS, 3),
+    (LAMP_TIMER, GET_RS, 1234),
+    (ACK_OK, ACK_RS, 0),
+]
+
+
+def junk(rnd, size, sof=True):
+    data = bytes(rnd.getrandbits(8) for _ in range(size))
+    if not sof:
+        data = data.replace(bytes([SOF]), b'\x00')
+    return data
+
+
+def stream(rnd, nframes, junkrate=0.3, sof=True):
+    ''' Return a stream of frames and junk, and the frames in it '''
+    out = bytearray()
+    frames = []
+    for _ in range(nframes):
+        if rnd.random() < junkrate:
+            out += junk(rnd, rnd.randint(1, 20), sof)
+        frame = rnd.choice(FRAMES)
+        frames.append(frame)
+        out += encode_hw50frame(*frame)
+    return bytes(out), frames
+
+
+def chunks(rnd, data, maxsize):
+    pos = 0
+    while pos < len(data):
+        size = rnd.randint(1, maxsize)
+        yield data[pos:pos+size]
+        pos += size
+
+
+def fuzz(iterations, seed):
+    rnd = random.Random(seed)
+    for i in range(iterations):
+        # Without stray SOF bytes in the junk, all frames must be found
+        data, frames = stream(rnd, rnd.randint(1, 50), sof=False)
+        framer = Hw50Framer()
+        found = []
+        for chunk in chunks(rnd, data, 16):
+            found += framer.feed(chunk)
+            assert len(framer.buffer) < FRAMESIZE, "Buffer not bounded"
+        assert found == frames, f"Iteration {i}: {found} != {frames}"
+
+        # With arbitrary junk, the framer must never fail, and must find
+        # at least the frames that are not overlapped by junk SOF bytes
+        data = junk(rnd, rnd.randint(0, 200))
+        framer = Hw50Framer()
+        for chunk in chunks(rnd, data, 16):
+            for frame in framer.feed(chunk):
+                assert encode_hw50frame(*frame) in data
+            assert len(framer.buffer) < FRAMESIZE, "Buffer not bounded"
+    print(f"Fuzz: {iterations} iterations OK")
+
+
+def bench(name, cls, data, chunksize):
+    framer = cls()
+    pieces = [data[i:i+chunksize] for i in range(0, len(data), chunksize)]
+    t0 = time.perf_counter()
+    n = 0
+    for piece in pieces:
+        n += len(framer.feed(piece))
+    elapsed = time.perf_counter() - t0
+    print(f"    {name:8} {len(data) / elapsed / 1e6:8.2f} MB/s, "
+          f"{n} frames, {len(framer.buffer)} bytes retained")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HW50 framer benchmark")
+    parser.add_argument('--fuzz', type=int, default=2000, help='Fuzz iterations')
+    parser.add_argument('--seed', type=int, default=0)
+    opts = parser.parse_args()
+
+    fuzz(opts.fuzz, opts.seed)
+
+    rnd = random.Random(opts.seed)
+    data, _ = stream(rnd, 20000, junkrate=0, sof=False)
+    print("Frames, 8 byte chunks")
+    bench("new", Hw50Framer, data, 8)
+    bench("legacy", LegacyFramer, data, 8)
+
+    print("Frames, 1 byte chunks")
+    bench("new", Hw50Framer, data, 1)
+    bench("legacy", LegacyFramer, data, 1)
+
+    data = junk(rnd, 50000, sof=False)
+    print("Junk without SOF, 64 byte chunks")
+    bench("new", Hw50Framer, data, 64)
+    bench("legacy", LegacyFramer, data, 64)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+''' Load test of the HW50 protocol handler over a pseudo-terminal
+
+    Runs Hw50 through the real serial port path against Hw50PtyEmulator,
+    with concurrent GET and SET commands over all the settable items. The
+    emulator can inject jitter, dropped replies, junk bytes and NAKs. With
+    --ports, several emulated projectors run on the same event loop.
+
+    python -m benchmarks.bench_hw50_pty [--commands N] [--concurrency N]
+                                        [--ports N] [--retries N]
+                                        [--drop P] [--junk P] [--nak P] ...
+'''
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+from hatt.hw50 import Hw50, CommandError, SETTINGS, SET_RQ, GET_RQ, BAUDRATE
+from hatt.hw50emu import Hw50PtyEmulator
+
+
+async def worker(hw50, rng, commands, latencies, errors):
+    for _ in range(commands):
+        item = rng.choice(SETTINGS)
+        if rng.random() < 0.5:
+            cmd, data = GET_RQ, 0
+        else:
+            cmd, data = SET_RQ, rng.randrange(100)
+        t0 = time.perf_counter()
+        try:
+            await hw50.command(item, cmd, data)
+            latencies.append(time.perf_counter() - t0)
+        except TimeoutError:
+            errors['timeout'] += 1
+        except CommandError:
+            errors['nak'] += 1
+
+
+async def bench(opts):
+    ports = []
+    for i in range(opts.ports):
+        emulator = Hw50PtyEmulator(
+            delay=opts.delay, jitter=opts.jitter, baudrate=opts.baudrate,
+            drop=opts.drop, junk=opts.junk, nak=opts.nak, seed=opts.seed + i,
+        )
+        transport, hw50 = await Hw50.connect(emulator.path, **emulator.serial_settings)
+        hw50.timeout = opts.timeout
+        hw50.retries = opts.retries
+        ports.append((emulator, transport, hw50))
+
+    rng = random.Random(opts.seed)
+    latencies = []
+    errors = {'timeout': 0, 'nak': 0}
+    per_worker = opts.commands // opts.concurrency
+
+    t0 = time.perf_counter()
+    cpu0 = time.process_time()
+    await asyncio.gather(*[
+        worker(hw50, rng, per_worker, latencies, errors)
+        for _, _, hw50 in ports
+        for _ in range(opts.concurrency)
+    ])
+    elapsed = time.perf_counter() - t0
+    cpu = time.process_time() - cpu0
+
+    for emulator, transport, _ in ports:
+        transport.close()
+        emulator.close()
+
+    total = per_worker * opts.concurrency * opts.ports
+    latencies.sort()
+    print(f"{total} commands, {opts.ports} port(s), {opts.concurrency} concurrent per port, "
+          f"{elapsed:.2f} s")
+    print(f"    {total / elapsed:.1f} commands/s, {cpu / total * 1e6:.0f} us CPU per command")
+    if latencies:
+        print(f"    latency min/median/p95/max {latencies[0] * 1000:.1f}/"
+              f"{latencies[len(latencies) // 2] * 1000:.1f}/"
+              f"{latencies[int(len(latencies) * 0.95)] * 1000:.1f}/"
+              f"{latencies[-1] * 1000:.1f} ms")
+    print(f"    {len(latencies)} ok, {errors['timeout']} timeouts, {errors['nak']} NAKs")
+    for emulator, _, hw50 in ports:
+        framer = hw50.codec
+        print(f"    {emulator.path}:")
+        print(f"        emulator: {emulator.requests} requests, {emulator.dropped} dropped, "
+              f"{emulator.naks} NAKs, {emulator.junkbytes} junk bytes")
+        print(f"        framer: {framer.frames} frames, {framer.junk} junk bytes, "
+              f"{framer.errors} framing errors")
+        print("        port: " + ', '.join(f"{k} {v}" for k, v in hw50.stats().items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HW50 load test over a pty")
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent commands per port')
+    parser.add_argument('--ports', type=int, default=1, help='Number of emulated projectors')
+    parser.add_argument('--delay', type=float, default=0.001, help='Reply delay. Default 0.001')
+    parser.add_argument('--jitter', type=float, default=0.002, help='Random extra reply delay. Default 0.002')
+    parser.add_argument('--baudrate', type=int, default=BAUDRATE,
+                        help=f'Reply byte rate. Default {BAUDRATE}. 0 sends each reply at once')
+    parser.add_argument('--drop', type=float, default=0.01, help='Probability of dropped replies. Default 0.01')
+    parser.add_argument('--junk', type=float, default=0.05, help='Probability of junk before replies. Default 0.05')
+    parser.add_argument('--nak', type=float, default=0.01, help='Probability of NAK replies. Default 0.01')
+    parser.add_argument('--timeout', type=float, default=0.2, help='Command timeout. Default 0.2')
+    parser.add_argument('--retries', type=int, default=0, help='Retries of timed out commands')
+    parser.add_argument('--seed', type=int, default=1)
+    opts = parser.parse_args()
+
+    # The timeouts are expected, don't log them
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(bench(opts))
+
+
+if __name__ == '__main__':
+    main()
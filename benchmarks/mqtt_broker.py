@@ -0,0 +1,282 @@
+''' Minimal MQTT 3.1.1 broker for benchmarks and testing
+
+    python -m benchmarks.mqtt_broker [--host HOST] [--port PORT]
+
+    It supports what hatt uses: QoS 0-2 publishing, retained messages,
+    wills, subscriptions with wildcards and persistent sessions. Messages
+    are always delivered with QoS 0. The persistent sessions keep the
+    subscriptions, and queue the QoS 1 and 2 messages while the client is
+    disconnected. They are kept in memory only.
+'''
+import argparse
+import asyncio
+import logging
+import struct
+
+
+log = logging.getLogger(__name__)
+
+# Packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+UINT16 = struct.Struct('>H')
+
+
+def encode_length(size):
+    out = bytearray()
+    while True:
+        b = size & 0x7F
+        size >>= 7
+        out.append(b | 0x80 if size else b)
+        if not size:
+            return out
+
+
+def encode_string(s):
+    if isinstance(s, str):
+        s = s.encode()
+    return UINT16.pack(len(s)) + s
+
+
+def decode_string(buf, pos):
+    size, = UINT16.unpack_from(buf, pos)
+    pos += 2
+    return bytes(buf[pos:pos+size]), pos + size
+
+
+def packet(ptype, flags, body=b''):
+    return bytes([ptype << 4 | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, retain=False):
+    return packet(PUBLISH, int(retain), encode_string(topic) + payload)
+
+
+def topic_matches(pattern, topic):
+    ''' Return True if topic matches the subscription pattern '''
+    if pattern == topic:
+        return True
+    plevels = pattern.split('/')
+    tlevels = topic.split('/')
+    for i, p in enumerate(plevels):
+        if p == '#':
+            return True
+        if i >= len(tlevels) or (p != '+' and p != tlevels[i]):
+            return False
+    return len(plevels) == len(tlevels)
+
+
+class Session(asyncio.Protocol):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.transport = None
+        self.buffer = bytearray()
+        self.client_id = None
+        self.persistent = False
+        self.subscriptions = {}
+        self.will = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.broker.sessions.discard(self)
+        if self.broker.clients.get(self.client_id) is self:
+            del self.broker.clients[self.client_id]
+            if self.persistent:
+                self.broker.offline[self.client_id] = (self.subscriptions, [])
+        if self.will:
+            self.broker.publish(*self.will)
+
+    def send(self, data):
+        if self.transport and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def data_received(self, data):
+        buf = self.buffer
+        buf += data
+        pos = 0
+        while len(buf) - pos >= 2:
+            # Decode the remaining length of the fixed header
+            size = 0
+            shift = 0
+            x = pos + 1
+            while True:
+                if x >= len(buf):
+                    size = None
+                    break
+                b = buf[x]
+                x += 1
+                size |= (b & 0x7F) << shift
+                shift += 7
+                if not b & 0x80:
+                    break
+            if size is None or len(buf) - x < size:
+                break
+            self.packet_received(buf[pos] >> 4, buf[pos] & 0x0F, bytes(buf[x:x+size]))
+            pos = x + size
+        del buf[:pos]
+
+    def packet_received(self, ptype, flags, body):
+        if ptype == CONNECT:
+            _, pos = decode_string(body, 0)
+            cflags = body[pos + 1]
+            self.client_id, pos = decode_string(body, pos + 4)
+            if cflags & 0x04:
+                topic, pos = decode_string(body, pos)
+                payload, pos = decode_string(body, pos)
+                self.will = (topic.decode(), payload, bool(cflags & 0x20), (cflags >> 3) & 0x03)
+            self.persistent = bool(self.client_id) and not cflags & 0x02
+            queued = self.broker.connect(self)
+            self.send(packet(CONNACK, 0, bytes([queued is not None, 0])))
+            for data in queued or ():
+                self.send(data)
+
+        elif ptype == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic, pos = decode_string(body, 0)
+            if qos:
+                pid = body[pos:pos+2]
+                pos += 2
+                self.send(packet(PUBACK if qos == 1 else PUBREC, 0, pid))
+            self.broker.publish(topic.decode(), body[pos:], bool(flags & 0x01), qos)
+
+        elif ptype == PUBREL:
+            self.send(packet(PUBCOMP, 0, body[:2]))
+
+        elif ptype == SUBSCRIBE:
+            pos = 2
+            topics = []
+            while pos < len(body):
+                topic, pos = decode_string(body, pos)
+                self.subscriptions[topic.decode()] = body[pos]
+                pos += 1
+                topics.append(topic.decode())
+            self.send(packet(SUBACK, 0, body[:2] + bytes(len(topics))))
+            for topic in topics:
+                self.broker.send_retained(self, topic)
+
+        elif ptype == UNSUBSCRIBE:
+            pos = 2
+            while pos < len(body):
+                topic, pos = decode_string(body, pos)
+                self.subscriptions.pop(topic.decode(), None)
+            self.send(packet(UNSUBACK, 0, body[:2]))
+
+        elif ptype == PINGREQ:
+            self.send(packet(PINGRESP, 0))
+
+        elif ptype == DISCONNECT:
+            self.will = None
+            self.transport.close()
+
+    def deliver(self, topic, data):
+        for pattern in self.subscriptions:
+            if topic_matches(pattern, topic):
+                self.send(data)
+                return
+
+
+class Broker:
+
+    def __init__(self):
+        self.server = None
+        self.sessions = set()
+        self.retained = {}
+        self.messages = 0
+
+        # Connected sessions by client id, and the subscriptions and queued
+        # messages of the disconnected persistent sessions
+        self.clients = {}
+        self.offline = {}
+
+    async def start(self, host='127.0.0.1', port=1883):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: Session(self), host, port)
+        return self
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for session in list(self.sessions):
+            session.transport.close()
+        await self.server.wait_closed()
+
+    def connect(self, session):
+        ''' Register a connected session. Returns the queued messages if a
+            persistent session is resumed, otherwise None.
+        '''
+        client_id = session.client_id
+        old = self.clients.get(client_id)
+        if old:
+            # A client id can only be connected once
+            old.transport.close()
+        if client_id:
+            self.clients[client_id] = session
+        self.sessions.add(session)
+
+        stored = self.offline.pop(client_id, None)
+        if not session.persistent or not stored:
+            return None
+        session.subscriptions, queued = stored
+        return queued
+
+    def publish(self, topic, payload, retain=False, qos=0):
+        self.messages += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        data = publish_packet(topic, payload)
+        for session in list(self.sessions):
+            session.deliver(topic, data)
+        if qos:
+            for subscriptions, queue in self.offline.values():
+                if any(sqos and topic_matches(pattern, topic)
+                       for pattern, sqos in subscriptions.items()):
+                    queue.append(data)
+
+    def send_retained(self, session, pattern):
+        for topic, payload in self.retained.items():
+            if topic_matches(pattern, topic):
+                session.send(publish_packet(topic, payload, retain=True))
+
+
+async def _serve(host, port):
+    broker = await Broker().start(host, port)
+    log.info("MQTT broker listening on %s:%s", host, broker.port)
+    # Tell a parent process which port is in use
+    print(broker.port, flush=True)
+    async with broker.server:
+        await broker.server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmarks.mqtt_broker',
+                                     description='Minimal MQTT broker')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883, help='Port. 0 selects a free port')
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_serve(opts.host, opts.port))
+    except KeyboardInterrupt:
+        pass
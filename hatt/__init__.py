@@ -1,8 +1,15 @@
 
 import argparse
-import json
-from importlib import import_module
 import asyncio
+import socket
+
+from .hatt import MqttHub
+from .log import setup_logging, WORKER_FORMAT
+from . import config
+from . import metrics
+from . import startup
+from .runner import Runner, device_main
+from .state import set_json_backend
 
 
 PROG = "hatt"
@@ -14,38 +21,78 @@ async def amain(coros):
     await asyncio.gather(*[asyncio.create_task(co) for co in coros])
 
 
-def main():
+def create_mains(conf, devices, name):
+    ''' Return the main coroutines of the devices and their MQTT hubs. name
+        is the name of the hatt instance. The plugins are imported when the
+        device mains start.
+    '''
+    startup.start(devices)
+
+    hubs = {}
+    mains = []
+    for device in devices:
+        data = config.device_conf(conf, device)
+        key, hubconf = config.hub_conf(conf, data, name)
+        if key not in hubs:
+            hubs[key] = MqttHub(hubconf)
+        mains.append(device_main(data, hubs[key]))
+
+    # The hubs start connecting first
+    return [hub.main() for hub in hubs.values()] + mains
 
-    from pprint import pprint
+
+def main():
 
     # Parse arguments
     parser = argparse.ArgumentParser(prog=PROG, description=DESCRIPTION)
     parser.add_argument('--conf', '--config', '-c', metavar='FILE', help=f'Configuration file. Default: {CONFFILE}',
                         default=CONFFILE)
+    parser.add_argument('--log-level', '-l', metavar='LEVEL', help='Log level. Default: INFO')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='Print the startup timeline of the devices')
     parser.add_argument('devices', metavar='NAMES', nargs="*", help='Devices to start')
 
     opts = parser.parse_args()
 
-    # Read config
-    with open(opts.conf, 'r') as f:
-        conf = json.load(f)
-
-    devices = opts.devices or conf.get('start', [])
-    if not devices:
-        parser.error("Missing device")
-
-    mains = []
-    for device in devices:
-        if device not in conf.get('devices', {}):
-            parser.error(f"{opts.conf}: No device '{device}' found")
-
-        data = conf['devices'][device]
-        data['id'] = device
-        data['broker'] = conf['broker']
-        data['reconnect_interval'] = conf.get('reconnect_interval', 3)
-
-        plugin = import_module('hatt.' + data['module'])
-        mains.append(plugin.main(data))
-
-    # Run the main loop
-    asyncio.run(amain(mains))
+    # Read and validate the config. The settings added here are kept over
+    # reloads
+    source = config.ConfigFile(opts.conf, opts.devices)
+    try:
+        conf, devices = source.load()
+    except (OSError, ValueError) as e:
+        parser.error(f"{opts.conf}: {e}")
+    conf = dict(conf)
+
+    # Name of this hatt instance, used for the shared connection status
+    name = conf.get('name', socket.gethostname())
+
+    if 'supervisor' in conf:
+        conf.setdefault('log_format', WORKER_FORMAT)
+    if opts.startup_profile:
+        conf['startup_profile'] = True
+    startup.enabled = conf.get('startup_profile', False)
+
+    listener = setup_logging(conf, opts.log_level)
+    set_json_backend(conf.get('json_backend'))
+
+    try:
+        if 'supervisor' in conf:
+            # Run the devices in worker processes
+            from .supervisor import Supervisor
+            Supervisor(conf, devices, name, opts.log_level, source).run()
+            return
+
+        mains = [Runner(conf, devices, name, source).main()]
+
+        # Optional metrics endpoint
+        if 'metrics' in conf:
+            metrics.enabled = True
+            mains.append(metrics.serve(conf['metrics']))
+
+        # Run the main loop
+        asyncio.run(amain(mains))
+    finally:
+        # Devices that never came online
+        startup.report()
+        if listener:
+            listener.stop()
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import struct
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+# Capture file format
+# The file starts with the MAGIC, followed by records of
+#     RECORD header: timestamp (float64, seconds since epoch),
+#                    direction (uint8, RX or TX), size (uint16)
+#     DATA: size bytes of raw serial data
+# The file is only appended to, so captures from several runs can be
+# stored in the same file.
+
+MAGIC = b'HATTCAP1'
+RECORD = struct.Struct('<dBH')
+
+RX = 0
+TX = 1
+DIRECTIONS = {RX: "RX", TX: "TX"}
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureWriter:
+    ''' Append timestamped raw serial data to a capture file '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write(self, direction, data):
+        # Records are limited to 64k, which a single read never exceeds
+        for pos in range(0, len(data), 0xFFFF):
+            chunk = data[pos:pos+0xFFFF]
+            self.file.write(RECORD.pack(time.time(), direction, len(chunk)))
+            self.file.write(chunk)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    ''' Read a capture file. Yields (timestamp, direction, data) '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureError(f"{path}: Not a capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, direction, size = RECORD.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield timestamp, direction, data
+
+
+class NullTransport(asyncio.Transport):
+    ''' Transport discarding everything written to it '''
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+async def replay(records, protocol, speed=1.0):
+    ''' Feed the RX records of a capture into protocol.data_received(). The
+        records are fed with the original timing divided by speed. With
+        speed 0 the records are fed as fast as possible. Returns the
+        number of bytes fed and the largest lag behind the original timing
+        in seconds.
+    '''
+    loop = asyncio.get_running_loop()
+    start = None
+    nbytes = 0
+    maxlag = 0
+    for timestamp, direction, data in records:
+        if direction != RX:
+            continue
+        if speed:
+            if start is None:
+                start = (loop.time(), timestamp)
+            due = start[0] + (timestamp - start[1]) / speed
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            maxlag = max(maxlag, loop.time() - due)
+        protocol.data_received(data)
+        nbytes += len(data)
+    return nbytes, maxlag
+
+
+def roundtrips(records):
+    ''' Return the times from each TX record until the following RX record '''
+    times = []
+    sent = None
+    for timestamp, direction, _ in records:
+        if direction == TX:
+            sent = timestamp
+        elif sent is not None:
+            times.append(timestamp - sent)
+            sent = None
+    return times
+
+
+async def _replay_hw50(path, speed):
+    from .hw50 import Hw50
+
+    protocol = Hw50()
+    protocol.connection_made(NullTransport())
+    records = list(read_capture(path))
+
+    t0 = time.perf_counter()
+    nbytes, maxlag = await replay(records, protocol, speed)
+    elapsed = time.perf_counter() - t0
+
+    framer = protocol.codec
+    print(f"{path}: {len(records)} records, {nbytes} bytes replayed in {elapsed:.3f} s")
+    print(f"    {framer.frames} frames, {framer.junk} junk bytes, {framer.errors} framing errors")
+    if speed:
+        print(f"    Max lag behind capture timing {maxlag * 1000:.3f} ms")
+    else:
+        print(f"    {nbytes / elapsed / 1e6:.2f} MB/s")
+
+    times = roundtrips(records)
+    if times:
+        print(f"    Round trip min/avg/max {min(times) * 1000:.1f}/"
+              f"{sum(times) / len(times) * 1000:.1f}/{max(times) * 1000:.1f} ms")
+
+
+def _dump(path):
+    from .hw50 import dump
+    for timestamp, direction, data in read_capture(path):
+        print(f"{timestamp:.6f} {DIRECTIONS.get(direction, '??')} {dump(data)}")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog='hatt.capture',
+                                     description='Replay HW50 serial captures')
+    parser.add_argument('file', help='Capture file')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='Replay speed relative to the capture. Default 0, as fast as possible')
+    parser.add_argument('--dump', action='store_true', help='Print the records')
+    opts = parser.parse_args()
+    if opts.dump:
+        _dump(opts.file)
+    else:
+        asyncio.run(_replay_hw50(opts.file, opts.speed))
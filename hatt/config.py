@@ -0,0 +1,308 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+from importlib.util import find_spec
+
+from . import dmx
+from . import dmxnet
+
+
+log = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    ''' Invalid configuration '''
+
+
+# Config schema. The keys map to the accepted value types. Keys not listed
+# are rejected, except in the devices of modules without a schema here.
+NUMBER = (int, float)
+
+SCHEMA = {
+    'broker': str,
+    'broker_port': int,
+    'reconnect_interval': NUMBER,
+    'reconnect_max': NUMBER,
+    'persistent_session': bool,
+    'subscribe_qos': int,
+    'name': str,
+    'topic': str,
+    'shared_connection': bool,
+    'log_level': str,
+    'log_levels': dict,
+    'log_format': str,
+    'log_queue': bool,
+    'json_backend': str,
+    'metrics': dict,
+    'supervisor': dict,
+    'startup_profile': bool,
+    'watch_config': NUMBER,
+    'start': list,
+    'devices': dict,
+}
+REQUIRED = ('broker', 'devices')
+
+DEVICE_SCHEMA = {
+    'module': str,
+    'name': str,
+    'unique_id': str,
+    'topic': str,
+    'device': dict,
+    'broker': str,
+    'broker_port': int,
+    'status_interval': NUMBER,
+    'retained_timeout': NUMBER,
+    'dispatch_concurrency': int,
+    'dispatch_queue': int,
+    'coalesce': bool,
+}
+DEVICE_REQUIRED = ('module', 'name', 'unique_id', 'topic', 'device')
+
+MODULE_SCHEMAS = {
+    'hw50': {
+        'port': str,
+        'capture': str,
+        'emulate': (bool, dict),
+        'poll': dict,
+        'retries': int,
+    },
+    'ola': {
+        'olad_host': str,
+        'olad_port': int,
+        'dmx_fps': NUMBER,
+        'dmx_keepalive': NUMBER,
+        'output': str,
+        'output_host': str,
+        'output_port': int,
+        'output_universes': dict,
+        'output_interface': str,
+        'output_source': str,
+        'output_priority': int,
+        'monitor': bool,
+        'monitor_interval': NUMBER,
+        'monitor_adopt': bool,
+        'fixtures': dict,
+    },
+}
+
+OLA_OUTPUTS = ('olad', 'sacn', 'artnet')
+
+FIXTURE_SCHEMA = {
+    'name': str,
+    'unique_id': str,
+    'topic': str,
+    'universe': int,
+    'address': int,
+    'channels': str,
+}
+
+# Keys of older configs that are no longer used. They are accepted, but
+# ignored with a warning.
+DEPRECATED = ('publish_interval',)
+
+# Settings used when starting hatt, which a reload can't change
+STATIC = ('name', 'log_level', 'log_levels', 'log_format', 'log_queue',
+          'json_backend', 'metrics', 'supervisor', 'startup_profile', 'watch_config')
+
+
+def _check(errors, where, conf, schema, required=(), strict=True):
+    if not isinstance(conf, dict):
+        errors.append(f"{where}: Must be an object")
+        return
+    for key in required:
+        if key not in conf:
+            errors.append(f"{where}: Missing '{key}'")
+    for key, value in conf.items():
+        if key in DEPRECATED:
+            log.warning("%s: '%s' is deprecated and ignored", where, key)
+            continue
+        types = schema.get(key)
+        if types is None:
+            if strict:
+                errors.append(f"{where}: Unknown key '{key}'")
+            continue
+        types = types if isinstance(types, tuple) else (types,)
+        # bool is a subclass of int, so it's only accepted where listed
+        if not isinstance(value, types) or isinstance(value, bool) and bool not in types:
+            errors.append(f"{where}: '{key}' has the wrong type {type(value).__name__}")
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_ola(errors, where, data):
+    output = data.get('output', 'olad')
+    if output not in OLA_OUTPUTS:
+        errors.append(f"{where}: 'output' must be one of {', '.join(OLA_OUTPUTS)}")
+        return
+    if output == 'olad':
+        first, last = 0, 0xFFFFFFFF
+    else:
+        first, last = dmxnet.SENDERS[output].min_universe, dmxnet.SENDERS[output].max_universe
+
+    fixtures = data.get('fixtures')
+    if not isinstance(fixtures, dict):
+        return
+    for fid, fconf in fixtures.items():
+        fwhere = f"{where}.fixtures.{fid}"
+        _check(errors, fwhere, fconf, FIXTURE_SCHEMA)
+        if not isinstance(fconf, dict):
+            continue
+
+        # The checks of the fixture setup, so that a bad edit is rejected
+        # before the running device is stopped by a reload
+        channels = None
+        layout = fconf.get('channels', 'rgbw')
+        if isinstance(layout, str):
+            try:
+                channels = dmx.channel_layout(layout)
+            except ValueError as e:
+                errors.append(f"{fwhere}: {e}")
+        address = fconf.get('address', 1)
+        if channels and _is_int(address) and not 1 <= address <= dmx.DMX_SIZE - len(channels) + 1:
+            errors.append(f"{fwhere}: DMX address {address} out of range for {len(channels)} channels")
+        # The fixtures default to the first universe of the output
+        universe = fconf.get('universe', first)
+        if _is_int(universe) and not first <= universe <= last:
+            errors.append(f"{fwhere}: Universe {universe} out of range {first}-{last} of {output}")
+
+
+def validate(conf, devices=()):
+    ''' Validate the config against the schema. Raises ConfigError with all
+        the problems found.
+    '''
+    errors = []
+    _check(errors, "config", conf, SCHEMA, REQUIRED)
+    if errors:
+        raise ConfigError('\n'.join(errors))
+
+    for device in devices:
+        if device not in conf['devices']:
+            errors.append(f"No device '{device}' found")
+
+    for device, data in conf['devices'].items():
+        where = f"devices.{device}"
+        module = data.get('module') if isinstance(data, dict) else None
+        schema = MODULE_SCHEMAS.get(module)
+        _check(errors, where, data, dict(DEVICE_SCHEMA, **(schema or {})),
+               DEVICE_REQUIRED, strict=schema is not None)
+        if not isinstance(module, str):
+            continue
+        if not find_spec('hatt.' + module):
+            errors.append(f"{where}: No module '{module}'")
+
+        if module == 'hw50' and not data.get('emulate') and 'port' not in data:
+            errors.append(f"{where}: Missing 'port'")
+        if module == 'ola':
+            _check_ola(errors, where, data)
+
+    if errors:
+        raise ConfigError('\n'.join(errors))
+
+
+def load(path, devices=None):
+    ''' Read and validate the config file. Returns the config and the
+        devices to start, which defaults to the start list of the config.
+    '''
+    with open(path, 'r') as f:
+        conf = json.load(f)
+    if not isinstance(conf, dict):
+        raise ConfigError("config: Must be an object")
+    devices = devices or conf.get('start', [])
+    if not devices:
+        raise ConfigError("Missing device")
+    validate(conf, devices)
+    return conf, list(devices)
+
+
+def device_conf(conf, device):
+    ''' Return a copy of the config of device, with the settings inherited
+        from the top level
+    '''
+    data = copy.deepcopy(conf['devices'][device])
+    data['id'] = device
+    data.setdefault('broker', conf['broker'])
+    data.setdefault('broker_port', conf.get('broker_port', 1883))
+    data['reconnect_interval'] = conf.get('reconnect_interval', 3)
+    return data
+
+
+def hub_conf(conf, data, name):
+    ''' Return the key and config of the MQTT hub of a device config. name
+        is the name of the hatt instance.
+    '''
+    # All devices share one MQTT connection per broker, unless
+    # shared_connection is disabled, where each device gets its own
+    shared = conf.get('shared_connection', True)
+    key = (data['broker'], data['broker_port']) if shared else data['id']
+    hubname = name if shared else f"{name}-{data['id']}"
+    return key, {
+        'name': hubname,
+        'broker': data['broker'],
+        'port': data['broker_port'],
+        'reconnect_interval': data['reconnect_interval'],
+        'reconnect_max': conf.get('reconnect_max', 60),
+        'persistent_session': conf.get('persistent_session', True),
+        'subscribe_qos': conf.get('subscribe_qos', 1),
+        'topic': f"{conf.get('topic', 'hatt')}/{hubname}",
+    }
+
+
+def keep_static(conf, previous, running):
+    ''' Return the new conf with the static settings of the running config.
+        A warning is logged for the static settings that were changed since
+        the previous config.
+    '''
+    conf = dict(conf)
+    for key in STATIC:
+        if conf.get(key) != previous.get(key):
+            log.warning("Changing '%s' requires a restart", key)
+        if key in running:
+            conf[key] = running[key]
+        else:
+            conf.pop(key, None)
+    return conf
+
+
+class ConfigFile:
+    ''' The config file, which is read again on reloads. devices are the
+        devices given on the command line, which override the start list.
+    '''
+
+    def __init__(self, path, devices=None):
+        self.path = path
+        self.devices = devices
+        self.loaded = {}
+
+    def load(self):
+        conf, devices = load(self.path, self.devices)
+        self.loaded = conf
+        return conf, devices
+
+    def reload(self, running):
+        ''' Read the config again. Returns the new config with the static
+            settings of the running config, and the devices to run.
+        '''
+        previous = self.loaded
+        conf, devices = self.load()
+        return keep_static(conf, previous, running), devices
+
+
+async def watch(path, interval, reload):
+    ''' Call reload() when the config file is modified '''
+    def mtime():
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    last = mtime()
+    while True:
+        await asyncio.sleep(interval)
+        current = mtime()
+        if current is not None and current != last:
+            last = current
+            await reload()
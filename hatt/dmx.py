@@ -0,0 +1,221 @@
+import asyncio
+import collections
+import logging
+
+from . import metrics
+
+
+log = logging.getLogger(__name__)
+
+FRAMES_SENT = metrics.Counter('hatt_dmx_frames_total', 'DMX frames sent', ('universe',))
+
+
+DMX_SIZE = 512
+
+# Default maximum refresh rate, which is the maximum rate of DMX512
+DEFAULT_FPS = 44
+DEFAULT_KEEPALIVE = 1.0
+
+# Channel layouts of the fixtures. Each letter is one DMX channel:
+#     r, g, b: Color channels
+#     w: White channel
+#     d: Dimmer (master brightness) channel
+LAYOUTS = {
+    "rgb": "rgb",
+    "rgbw": "rgbw",
+    "drgb": "drgb",
+    "drgbw": "drgbw",
+    "rgbwd": "rgbwd",
+    "dimmer": "d",
+}
+
+# Number of sent frames kept to recognize their echoes from olad
+SENT_FRAMES = 16
+
+
+def channel_layout(layout):
+    ''' Return the channels of a layout name, or of a combination of the
+        channel letters
+    '''
+    channels = LAYOUTS.get(layout, layout)
+    if not channels or set(channels) - set("rgbwd"):
+        raise ValueError(f"Unknown channel layout '{layout}'")
+    return channels
+
+
+class Fade:
+    ''' Linear fade of a range of channels '''
+    __slots__ = ('start', 'delta', 'end', 'begin', 'duration', 'done')
+
+    def __init__(self, start, end, begin, duration, done=None):
+        self.start = start
+        self.end = bytes(end)
+        self.delta = [e - s for s, e in zip(start, self.end)]
+        self.begin = begin
+        self.duration = duration
+        self.done = done
+
+    def render(self, frame, address, now):
+        ''' Write the fade values at time now into the frame. Returns True
+            when the fade is complete.
+        '''
+        k = (now - self.begin) / self.duration
+        if k >= 1:
+            frame[address:address+len(self.end)] = self.end
+            return True
+        frame[address:address+len(self.end)] = bytes(
+            [int(s + d * k) for s, d in zip(self.start, self.delta)]
+        )
+        return False
+
+
+class Universe:
+    ''' Output scheduler for one DMX universe. It keeps the frame for the
+        universe, and updates only mark the frame as dirty. The frame is
+        sent at most fps times per second, so intermediate values are
+        dropped and only the latest value is sent. When idle the frame is
+        refreshed every keepalive seconds. All active fades are rendered in
+        the same frame tick.
+    '''
+
+    def __init__(self, ola, universe, fps=DEFAULT_FPS, keepalive=DEFAULT_KEEPALIVE):
+        self.ola = ola
+        self.universe = universe
+        self.fps = fps
+        self.keepalive = keepalive
+
+        self.frame = bytearray(DMX_SIZE)
+        self.size = 0
+        self.dirty = asyncio.Event()
+        self.fades = {}
+        self.task = None
+        self.view = memoryview(self.frame)
+
+        # The recently sent frames, when tracking the echoes
+        self.sent = None
+
+        # Statistics
+        self.updates = 0
+        self.frames = 0
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.main())
+
+    def update(self, address, values):
+        ''' Set the channels starting at address (0-based) '''
+        end = address + len(values)
+        self.fades.pop(address, None)
+        self.frame[address:end] = bytes(values)
+        self.size = max(self.size, end)
+        self.updates += 1
+        self.dirty.set()
+
+    def fade(self, address, values, duration, done=None):
+        ''' Fade the channels starting at address from their current values
+            to values over duration seconds. A running fade on the address
+            is replaced, and starts from where it was interrupted. done is
+            called when the fade completes.
+        '''
+        if duration <= 0:
+            self.update(address, values)
+            if done:
+                done()
+            return
+        end = address + len(values)
+        self.fades[address] = Fade(
+            self.frame[address:end], values,
+            asyncio.get_running_loop().time(), duration, done,
+        )
+        self.size = max(self.size, end)
+        self.updates += 1
+        self.dirty.set()
+
+    def adopt(self, address, values):
+        ''' Take the channels starting at address from the DMX data of
+            someone else. The frame isn't sent for it, but the values are
+            kept by the following frames.
+        '''
+        end = address + len(values)
+        self.frame[address:end] = values
+        self.size = max(self.size, end)
+
+    def track_echoes(self):
+        ''' Keep the recently sent frames for is_echo() '''
+        if self.sent is None:
+            self.sent = collections.deque(maxlen=SENT_FRAMES)
+
+    def is_echo(self, address, values):
+        ''' Return True if the channels starting at address have the values
+            of the current frame or of a recently sent frame
+        '''
+        end = address + len(values)
+        if self.frame[address:end] == values:
+            return True
+        return any(frame[address:end] == values for frame in self.sent or ())
+
+    def render(self, now):
+        ''' Render all active fades into the frame '''
+        frame = self.frame
+        for address, fade in list(self.fades.items()):
+            if fade.render(frame, address, now):
+                del self.fades[address]
+                if fade.done:
+                    fade.done()
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.fps
+        while True:
+            if not self.fades:
+                try:
+                    await asyncio.wait_for(self.dirty.wait(), self.keepalive)
+                except asyncio.TimeoutError:
+                    pass
+
+            self.dirty.clear()
+            if self.fades:
+                self.render(loop.time())
+            self.flush()
+
+            # Limit the frame rate
+            await asyncio.sleep(interval)
+
+    def flush(self):
+        if not self.size or not self.ola.connected:
+            return
+        self.frames += 1
+        if metrics.enabled:
+            FRAMES_SENT.inc(self.universe)
+        if self.sent is not None:
+            data = bytes(self.frame[:self.size])
+            self.sent.append(data)
+        else:
+            data = self.view[:self.size]
+
+        # The UDP outputs send at once, and return no future
+        future = self.ola.send_dmx(self.universe, data)
+        if future is not None:
+            future.add_done_callback(self._sent)
+
+    def _sent(self, future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc:
+            log.warning("DMX universe %s: Failed to send frame: %s", self.universe, exc)
+
+
+_universes = {}
+
+
+def get_universe(ola, universe, **kwargs):
+    ''' Return the process wide scheduler for a universe on an output,
+        which is an olad client or a UDP sender
+    '''
+    key = (ola, universe)
+    uni = _universes.get(key)
+    if not uni:
+        uni = _universes[key] = Universe(ola, universe, **kwargs)
+        uni.start()
+    return uni
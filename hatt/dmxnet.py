@@ -0,0 +1,363 @@
+import asyncio
+import atexit
+import logging
+import socket
+import struct
+import uuid
+
+
+log = logging.getLogger(__name__)
+
+
+# Direct DMX output over UDP, without olad. Each universe has a
+# preallocated packet, where the sequence number, the length fields and
+# the channel data are patched in place for every frame.
+
+DMX_SIZE = 512
+
+# sACN (ANSI E1.31)
+SACN_PORT = 5568
+SACN_HEADER = 126
+SACN_PRIORITY = 100
+SACN_MAX_UNIVERSE = 63999
+SACN_TERMINATED = 0x40
+
+# Art-Net 4, ArtDmx
+ARTNET_PORT = 6454
+ARTNET_HEADER = 18
+ARTNET_OPDMX = 0x5000
+ARTNET_VERSION = 14
+ARTNET_MAX_UNIVERSE = 0x7FFF
+
+U16 = struct.Struct('!H')
+
+
+def sacn_multicast(universe):
+    ''' Return the multicast group of a sACN universe '''
+    return f"239.255.{universe >> 8}.{universe & 0xFF}"
+
+
+class Packet:
+    ''' Preallocated packet of one universe '''
+    __slots__ = ('buffer', 'view', 'payload', 'size', 'sequence', 'address')
+
+    def __init__(self, header, address):
+        self.buffer = bytearray(header + DMX_SIZE)
+        self.view = memoryview(self.buffer)
+        self.payload = None
+        self.size = -1
+        self.sequence = 0
+        self.address = address
+
+
+class Sender:
+    ''' DMX output to UDP. The interface is the part of OlaClient used by
+        the DMX scheduler: send_dmx() patches the packet of the universe
+        and sends it at once. A frame the socket can't take is dropped, as
+        the next frame replaces it anyway.
+
+        host is the destination of the universes not found in universes,
+        which is {universe: host}.
+    '''
+    protocol = None
+    port = None
+    header = 0
+    min_universe = 0
+    max_universe = 0
+
+    # Pad the data to an even length
+    pad = 0
+
+    def __init__(self, host=None, port=None, universes=None, interface=None):
+        self.host = host
+        self.port = port or self.port
+        self.universes = {int(u): h for u, h in (universes or {}).items()}
+        self.packets = {}
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.setup(interface)
+
+        # Statistics
+        self.frames = 0
+        self.dropped = 0
+        self.failing = False
+
+    def setup(self, interface):
+        ''' Set the socket options '''
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def destination(self, universe):
+        return (self.universes.get(universe) or self.host, self.port)
+
+    def packet(self, universe):
+        ''' Return the packet of a universe, allocating it on first use '''
+        packet = self.packets.get(universe)
+        if packet:
+            return packet
+        if not self.min_universe <= universe <= self.max_universe:
+            raise ValueError(f"{self.protocol} universe {universe} out of range")
+        packet = self.packets[universe] = Packet(self.header, self.destination(universe))
+        self.init_packet(packet, universe)
+        return packet
+
+    def init_packet(self, packet, universe):
+        ''' Write the constant fields of the packet '''
+
+    def patch(self, packet, size):
+        ''' Update the length fields of the packet for size channels '''
+
+    def next_sequence(self, packet):
+        ''' Write the next sequence number into the packet '''
+
+    def send_dmx(self, universe, data, priority=None):
+        ''' Send DMX data to a universe. Returns None, as there is nothing
+            to wait for.
+        '''
+        packet = self.packets.get(universe) or self.packet(universe)
+        size = len(data)
+        if size != packet.size:
+            self.patch(packet, size)
+            packet.size = size
+            packet.payload = packet.view[:self.header + size + (size & self.pad)]
+        packet.view[self.header:self.header+size] = data
+        self.next_sequence(packet)
+        self.send(packet)
+
+    def send(self, packet):
+        try:
+            self.sock.sendto(packet.payload, packet.address)
+        except (BlockingIOError, InterruptedError):
+            self.dropped += 1
+            return
+        except OSError as e:
+            self.dropped += 1
+            if not self.failing:
+                self.failing = True
+                log.warning("%s: Failed to send to %s: %s", self.protocol, packet.address, e)
+            return
+        self.failing = False
+        self.frames += 1
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class SacnSender(Sender):
+    ''' sACN (E1.31) data packets. Universes are sent to their multicast
+        group unless a host is given. The source is identified by name and
+        a CID derived from it, so it stays the same across restarts.
+    '''
+    protocol = 'sACN'
+    port = SACN_PORT
+    header = SACN_HEADER
+    min_universe = 1
+    max_universe = SACN_MAX_UNIVERSE
+
+    def __init__(self, host=None, port=None, universes=None, interface=None,
+                 name='hatt', priority=SACN_PRIORITY):
+        self.name = name
+        self.priority = priority
+        self.cid = uuid.uuid5(uuid.NAMESPACE_DNS, f"{name}.{socket.gethostname()}").bytes
+        super().__init__(host, port, universes, interface)
+
+    def setup(self, interface):
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 8)
+        if interface:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                 socket.inet_aton(interface))
+
+    def destination(self, universe):
+        return (self.universes.get(universe) or self.host or sacn_multicast(universe), self.port)
+
+    def init_packet(self, packet, universe):
+        buf = packet.buffer
+        # Root layer
+        buf[0:4] = b'\x00\x10\x00\x00'
+        buf[4:16] = b'ASC-E1.17\x00\x00\x00'
+        buf[18:22] = b'\x00\x00\x00\x04'
+        buf[22:38] = self.cid
+        # Framing layer
+        buf[40:44] = b'\x00\x00\x00\x02'
+        buf[44:44+64] = self.name.encode()[:63].ljust(64, b'\x00')
+        buf[108] = self.priority
+        U16.pack_into(buf, 113, universe)
+        # DMP layer
+        buf[117] = 0x02
+        buf[118] = 0xA1
+        buf[121:123] = b'\x00\x01'
+
+    def patch(self, packet, size):
+        buf = packet.buffer
+        length = SACN_HEADER + size
+        U16.pack_into(buf, 16, 0x7000 | (length - 16))
+        U16.pack_into(buf, 38, 0x7000 | (length - 38))
+        U16.pack_into(buf, 115, 0x7000 | (length - 115))
+        U16.pack_into(buf, 123, size + 1)
+
+    def next_sequence(self, packet):
+        packet.sequence = (packet.sequence + 1) & 0xFF
+        packet.buffer[111] = packet.sequence
+
+    def close(self):
+        # Tell the receivers that the source is gone, rather than letting
+        # them wait for the data loss timeout
+        if self.sock:
+            for packet in self.packets.values():
+                if packet.payload is None:
+                    continue
+                packet.buffer[112] |= SACN_TERMINATED
+                for _ in range(3):
+                    self.next_sequence(packet)
+                    self.send(packet)
+        super().close()
+
+
+class ArtNetSender(Sender):
+    ''' Art-Net ArtDmx packets. The universe is the 15-bit port address.
+        Without a host the packets are broadcast.
+    '''
+    protocol = 'Art-Net'
+    port = ARTNET_PORT
+    header = ARTNET_HEADER
+    max_universe = ARTNET_MAX_UNIVERSE
+    pad = 1
+
+    def setup(self, interface):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if interface:
+            self.sock.bind((interface, 0))
+
+    def destination(self, universe):
+        return (self.universes.get(universe) or self.host or '255.255.255.255', self.port)
+
+    def init_packet(self, packet, universe):
+        buf = packet.buffer
+        buf[0:8] = b'Art-Net\x00'
+        struct.pack_into('<H', buf, 8, ARTNET_OPDMX)
+        U16.pack_into(buf, 10, ARTNET_VERSION)
+        buf[14] = universe & 0xFF
+        buf[15] = universe >> 8
+
+    def patch(self, packet, size):
+        # Art-Net needs at least 2 channels
+        U16.pack_into(packet.buffer, 16, max(2, size + (size & 1)))
+
+    def next_sequence(self, packet):
+        # The sequence runs 1-255, as 0 disables it
+        packet.sequence = packet.sequence % 255 + 1
+        packet.buffer[12] = packet.sequence
+
+
+SENDERS = {
+    'sacn': SacnSender,
+    'artnet': ArtNetSender,
+}
+
+_senders = {}
+
+
+def get_sender(output, host=None, port=None, universes=None, interface=None, **kwargs):
+    ''' Return the process wide sender for output, which is "sacn" or
+        "artnet"
+    '''
+    key = (output, host, port, tuple(sorted((universes or {}).items())), interface,
+           tuple(sorted(kwargs.items())))
+    sender = _senders.get(key)
+    if not sender:
+        sender = _senders[key] = SENDERS[output](host, port, universes, interface, **kwargs)
+        # The socket doesn't need the event loop, so the sACN sources can
+        # be terminated at exit
+        atexit.register(sender.close)
+    return sender
+
+
+class Receiver(asyncio.DatagramProtocol):
+    ''' Local stand-in for a sACN or Art-Net node for testing without DMX
+        hardware. It keeps the DMX data of the universes it receives, and
+        counts the frames lost by the sequence numbers.
+    '''
+
+    def __init__(self):
+        self.transport = None
+        self.universes = {}
+        self.sequences = {}
+        self.frames = 0
+        self.lost = 0
+        self.invalid = 0
+        self.terminated = set()
+
+    async def start(self, output, host='127.0.0.1', port=None, groups=()):
+        ''' Listen for output packets. For sACN multicast, groups are the
+            universes to join.
+        '''
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port if port is not None else SENDERS[output].port))
+        for universe in groups:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack(
+                '4s4s', socket.inet_aton(sacn_multicast(universe)), socket.inet_aton('0.0.0.0')))
+        await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    @property
+    def address(self):
+        return self.transport.get_extra_info('sockname')
+
+    def close(self):
+        self.transport.close()
+
+    def datagram_received(self, data, addr):
+        if data[4:16] == b'ASC-E1.17\x00\x00\x00' and len(data) >= SACN_HEADER:
+            universe, = U16.unpack_from(data, 113)
+            count, = U16.unpack_from(data, 123)
+            if data[112] & SACN_TERMINATED:
+                self.terminated.add(universe)
+                return
+            self.frame_received(universe, data[111], data[SACN_HEADER:SACN_HEADER+count-1], 256)
+        elif data[:8] == b'Art-Net\x00' and len(data) >= ARTNET_HEADER:
+            universe = data[14] | data[15] << 8
+            size, = U16.unpack_from(data, 16)
+            self.frame_received(universe, data[12], data[ARTNET_HEADER:ARTNET_HEADER+size], 255)
+        else:
+            self.invalid += 1
+
+    def frame_received(self, universe, sequence, data, modulo):
+        last = self.sequences.get(universe)
+        if last is not None:
+            self.lost += (sequence - last - 1) % modulo
+        self.sequences[universe] = sequence
+        self.universes[universe] = data
+        self.frames += 1
+
+
+async def _receiver(output, host, port, groups):
+    receiver = await Receiver().start(output, host, port, groups)
+    log.info("%s receiver listening on %s:%s", SENDERS[output].protocol, *receiver.address)
+    while True:
+        await asyncio.sleep(1)
+        for universe, data in sorted(receiver.universes.items()):
+            log.info("Universe %s: %s", universe, ' '.join(f'{b:02x}' for b in data[:16]))
+        log.info("%s frames, %s lost", receiver.frames, receiver.lost)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog='hatt.dmxnet', description='sACN or Art-Net receiver')
+    parser.add_argument('output', choices=SENDERS)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--join', type=int, nargs='*', default=[],
+                        help="sACN universes to join the multicast group of")
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_receiver(opts.output, opts.host, opts.port, opts.join))
@@ -1,9 +1,32 @@
 import asyncio
+import collections
 import contextlib
-import json
-from pprint import pprint
+import logging
+import os
+import random
+import time
 import asyncio_mqtt as mqtt
 
+from . import metrics
+from . import startup
+from . import state
+
+
+log = logging.getLogger(__name__)
+
+PUBLISH_TIME = metrics.Histogram('hatt_mqtt_publish_seconds',
+                                 'Time to publish a MQTT message', ('topic',))
+HANDLER_TIME = metrics.Histogram('hatt_message_handler_seconds',
+                                 'Time to process a received MQTT message', ('device',))
+DROPPED = metrics.Counter('hatt_messages_dropped_total',
+                          'Received MQTT messages dropped by a full queue', ('device',))
+COALESCED = metrics.Counter('hatt_messages_coalesced_total',
+                            'Received MQTT messages replaced by a newer message', ('device',))
+
+
+STATUS_ONLINE = "online"
+STATUS_OFFLINE = "offline"
+
 
 async def cancel_task(task):
     if not task or task.done():
@@ -15,101 +38,452 @@ async def cancel_task(task):
         pass
 
 
-class Hatt:
+class Dispatcher:
+    ''' Runs the handler for received messages in tasks. Messages on the
+        same topic are handled one at a time in order, while messages on
+        different topics are handled concurrently, with at most concurrency
+        handlers running at a time. At most queue_size messages are queued
+        per topic. When a queue is full the oldest message is dropped, so a
+        slow handler never blocks the routing of other messages.
+
+        On the coalesced topics, only the latest message matters. A new
+        message is combined with the unhandled message by merge(old, new),
+        which by default returns the new message.
+    '''
+
+    def __init__(self, name, handler, concurrency=8, queue_size=100, merge=None):
+        self.name = name
+        self.handler = handler
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue_size = queue_size
+        self.queues = {}
+        self.workers = {}
+        self.coalesce = set()
+        self.merge = merge or (lambda old, new: new)
+
+        # Statistics
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put(self, message):
+        topic = message.topic
+        queue = self.queues.get(topic)
+        if queue is None:
+            queue = self.queues[topic] = collections.deque()
+        if queue and topic in self.coalesce:
+            queue[-1] = self.merge(queue[-1], message)
+            self.coalesced += 1
+            if metrics.enabled:
+                COALESCED.inc(self.name)
+            return
+        if len(queue) >= self.queue_size:
+            queue.popleft()
+            self.dropped += 1
+            if metrics.enabled:
+                DROPPED.inc(self.name)
+            log.warning("%s: Queue for %s is full, dropping the oldest message",
+                        self.name, topic)
+        queue.append(message)
+        if topic not in self.workers:
+            self.workers[topic] = asyncio.create_task(self.worker(topic, queue))
+
+    async def worker(self, topic, queue):
+        # The worker exits when its queue is empty, and put() starts a new
+        try:
+            while queue:
+                message = queue.popleft()
+                async with self.semaphore:
+                    try:
+                        await self.handler(message)
+                    except mqtt.MqttError as error:
+                        log.error('%s: Error "%s" handling %s', self.name, error, topic)
+                    except Exception:
+                        log.exception("%s: Failed to handle %s", self.name, topic)
+        finally:
+            del self.workers[topic]
+
+    async def stop(self):
+        ''' Cancel all handlers and discard the queued messages '''
+        self.queues.clear()
+        for task in list(self.workers.values()):
+            await cancel_task(task)
+
+
+class MqttHub:
+    ''' A single MQTT connection shared by several Hatt devices. Subscribed
+        messages are routed to the devices by topic. The hub carries the LWT
+        for the connection, and the devices announce their availability both
+        on their own status topic and on the hub's status topic.
+
+        The connection uses a persistent session by default, so the broker
+        keeps the subscriptions and queues the QoS 1 messages while the hub
+        is disconnected. The devices are kept over reconnects.
+    '''
 
-    CONFIG_TOPIC = "config"
-    COMMAND_TOPIC = "set"
     STATUS_TOPIC = "status"
-    STATE_TOPIC = "state"
-    #ATTRIBUTE_TOPIC = "attribute"
-    STATUS_ONLINE = "online"
-    STATUS_OFFLINE = "offline"
-    HA_STATUS = "homeassistant/status"
 
     def __init__(self, conf):
         self.conf = conf
-
-        self.status = self.STATUS_OFFLINE
-        self.state = None
-        self.laststate = None
-
-        self.config_topic = f"{conf['topic']}/{self.CONFIG_TOPIC}"
-        self.command_topic = f"{conf['topic']}/{self.COMMAND_TOPIC}"
+        self.name = conf['name']
         self.status_topic = f"{conf['topic']}/{self.STATUS_TOPIC}"
-        self.state_topic = f"{conf['topic']}/{self.STATE_TOPIC}"
-        #self.attribute_topic = f"{conf['topic']}/{ATTRIBUTE_TOPIC}"
 
-        self.config_task = None
-        self.status_task = None
+        self.mqtt = None
+        self.online = False
+        self.devices = []
+        self.routes = {}
+        self.subscribed = set()
+
+        # The connected() tasks of the devices registered while online
+        self.connecting = {}
+
+    def register(self, device):
+        self.devices.append(device)
+        if self.mqtt:
+            task = self.connecting[device] = asyncio.create_task(device.connected())
+            task.add_done_callback(lambda t: self._connected(device, t))
+
+    def _connected(self, device, task):
+        if self.connecting.get(device) is task:
+            del self.connecting[device]
+        if not task.cancelled() and task.exception():
+            log.error("%s: Failed to start %s", self.name, device.conf['id'],
+                      exc_info=task.exception())
+
+    async def unregister(self, device):
+        self.devices.remove(device)
+        await cancel_task(self.connecting.get(device))
+        await device.disconnected()
+        for topic, devices in list(self.routes.items()):
+            if device in devices:
+                await self.unsubscribe(device, topic)
+        if self.mqtt:
+            await self.publish(device.status_topic, STATUS_OFFLINE,
+                               retain=True, qos=2)
+
+    async def subscribe(self, device, topic):
+        devices = self.routes.setdefault(topic, [])
+        if device not in devices:
+            devices.append(device)
+        if self.mqtt and topic not in self.subscribed:
+            log.info("Subscribing to %s", topic)
+            self.subscribed.add(topic)
+            await self.mqtt.subscribe(topic, qos=self.conf.get('subscribe_qos', 1))
+
+    async def unsubscribe(self, device, topic):
+        devices = self.routes.get(topic, [])
+        if device in devices:
+            devices.remove(device)
+        if not devices:
+            self.routes.pop(topic, None)
+            if self.mqtt and topic in self.subscribed:
+                log.info("Unsubscribing from %s", topic)
+                self.subscribed.discard(topic)
+                await self.mqtt.unsubscribe(topic)
 
-        self.config_event = asyncio.Event()
+    async def publish(self, topic, payload, **kwargs):
+        if not self.mqtt:
+            raise mqtt.MqttError(f"{self.name}: Not connected")
+        log.debug("<<< PUBLISH: %s: %s", topic, payload)
+        if metrics.enabled:
+            t0 = time.perf_counter()
+            result = await self.mqtt.publish(topic, payload, **kwargs)
+            PUBLISH_TIME.observe(time.perf_counter() - t0, topic)
+            return result
+        return await self.mqtt.publish(topic, payload, **kwargs)
 
     async def main(self):
+        # The reconnect delay starts at reconnect_interval after a lost
+        # connection, and doubles for each failed attempt up to
+        # reconnect_max. The delay is randomized, so that several clients
+        # don't reconnect at the same time after a broker restart.
+        reconnect_interval = self.conf['reconnect_interval']
+        reconnect_max = self.conf.get('reconnect_max', 60)
+        delay = 0
+        while True:
+            try:
+                if delay:
+                    await asyncio.sleep(random.uniform(delay / 2, delay))
 
-        async with contextlib.AsyncExitStack() as stack:
+                self.online = False
+                await self.run()
+
+            except mqtt.MqttError as error:
+                if self.online or not delay:
+                    delay = reconnect_interval
+                else:
+                    delay = min(delay * 2, reconnect_max)
+                log.error('%s: Error "%s". Reconnecting in %s-%s seconds.',
+                          self.name, error, delay / 2, delay)
 
-            async def _cancel_tasks():
-                await cancel_task(self.config_task)
-                await cancel_task(self.status_task)
+    async def run(self):
 
-            # Keep track of the asyncio tasks that we create, so that
-            # we can cancel them on exit
-            stack.push_async_callback(_cancel_tasks)
+        async with contextlib.AsyncExitStack() as stack:
 
-            # Create a LWT
+            # Create a LWT for the shared connection
             will = mqtt.Will(self.status_topic,
-                             payload=self.STATUS_OFFLINE, retain=True, qos=2)
+                             payload=STATUS_OFFLINE, retain=True, qos=2)
+
+            # Connect to the MQTT broker. A persistent session needs a
+            # stable client id.
+            persistent = self.conf.get('persistent_session', True)
+            log.info("%s: Connecting to %s", self.name, self.conf['broker'])
+            client = mqtt.Client(
+                self.conf["broker"], self.conf.get('port', 1883), will=will,
+                client_id=f"hatt-{self.name}" if persistent else None,
+                clean_session=not persistent,
+            )
 
-            # Connect to the MQTT broker
-            print(f"Connecting to {self.conf['broker']}")
-            client = mqtt.Client(self.conf["broker"], will=will)
+            # Receive the messages from the start, as the broker delivers
+            # the queued messages of a persistent session right away
+            messages = await stack.enter_async_context(client.unfiltered_messages())
             await stack.enter_async_context(client)
-            self.mqtt = client
+
+            async def _disconnected():
+                self.mqtt = None
+                self.subscribed.clear()
+
+            stack.push_async_callback(_disconnected)
 
             # Push a LWT-like message before disconnecting from the broker
             stack.push_async_callback(self.publish, will.topic,
                                       payload=will.payload,
                                       retain=will.retain, qos=will.qos)
 
-            # Handle every subscribed message using unfiltered_messages()
-            # Use client.filtered_message() if only a subset is wanted
-            messages = await stack.enter_async_context(client.unfiltered_messages())
+            async def _stop_devices():
+                for device in self.devices:
+                    await cancel_task(self.connecting.get(device))
+                    await device.disconnected()
 
-            print(f"Subscribing to {self.command_topic}")
-            await client.subscribe(self.command_topic)
-            await client.subscribe(self.HA_STATUS)
+            # Stop the device tasks before disconnecting from the broker
+            stack.push_async_callback(_stop_devices)
 
-            # Create the publisher tasks
-            self.config_task = asyncio.create_task(self.config_publisher())
-            self.status_task = asyncio.create_task(self.status_publisher())
+            # The devices registered from here on are connected by
+            # register()
+            devices = list(self.devices)
+            self.mqtt = client
+            self.online = True
 
-            # Start receiving messages
-            await self.message_handler(messages)
+            await self.publish(self.status_topic, STATUS_ONLINE,
+                               retain=True, qos=2)
 
-    async def restart_config_publisher(self):
-        self.config_event.clear()
-        await cancel_task(self.config_task)
+            # Let the devices subscribe and start their publishers. The
+            # devices come up concurrently.
+            await asyncio.gather(*[device.connected() for device in devices
+                                   if device in self.devices])
+
+            # Route the received messages to the subscribing devices
+            async for message in messages:
+                for device in self.routes.get(message.topic, ()):
+                    device.route(message)
+
+
+class Hatt:
+
+    CONFIG_TOPIC = "config"
+    COMMAND_TOPIC = "set"
+    STATUS_TOPIC = "status"
+    STATE_TOPIC = "state"
+    #ATTRIBUTE_TOPIC = "attribute"
+    STATUS_ONLINE = STATUS_ONLINE
+    STATUS_OFFLINE = STATUS_OFFLINE
+    HA_STATUS = "homeassistant/status"
+
+    def __init__(self, conf, hub):
+        self.conf = conf
+        self.hub = hub
+
+        self.status = self.STATUS_OFFLINE
+        self.state = state.State()
+
+        # Encoded discovery configs. The broker's retained messages of the
+        # device are stored in retained, with the content hashes of the
+        # configs and the payloads of the other topics. The topics are
+        # watched when connecting.
+        self.config_cache = None
+        self.retained = {}
+        self.retained_event = asyncio.Event()
+        self.watched = set()
+
+        # The broker sends the retained messages of a subscription before
+        # the messages published after it. A marker published on a private
+        # topic after subscribing comes back when all have been received.
+        self.marker_topic = f"{hub.conf['topic']}/sync/{conf['id']}"
+        self.marker = None
+
+        self.config_topic = f"{conf['topic']}/{self.CONFIG_TOPIC}"
+        self.command_topic = f"{conf['topic']}/{self.COMMAND_TOPIC}"
+        self.status_topic = f"{conf['topic']}/{self.STATUS_TOPIC}"
+        self.state_topic = f"{conf['topic']}/{self.STATE_TOPIC}"
+        #self.attribute_topic = f"{conf['topic']}/{ATTRIBUTE_TOPIC}"
+
+        # The device is only available when both the device and the shared
+        # connection are online
+        self.availability = [
+            {"topic": self.status_topic},
+            {"topic": hub.status_topic},
+        ]
+
+        self.config_task = None
+        self.status_task = None
+
+        self.config_event = asyncio.Event()
+        self.dispatcher = Dispatcher(
+            conf['id'], self.dispatch,
+            concurrency=conf.get('dispatch_concurrency', 8),
+            queue_size=conf.get('dispatch_queue', 100),
+            merge=self.merge_messages,
+        )
+
+    async def main(self):
+        self.hub.register(self)
+        try:
+            # Run until cancelled. The hub drives the device from here
+            await asyncio.get_running_loop().create_future()
+        finally:
+            await self.hub.unregister(self)
+
+    async def connected(self):
+        ''' Called by the hub when the MQTT connection is up '''
+
+        startup.mark(self.conf['id'], 'connect')
+
+        # Learn what the broker has retained of the device, so only what
+        # differs is published, e.g. after a reconnect
+        self.retained.clear()
+        self.retained_event.clear()
+        self.watched = set(self.encoded_configs()) | set(self.retained_topics())
+
+        # Subscribe to all topics at once rather than waiting for each
+        topics = list(self.watched) + [self.marker_topic] + self.subscriptions()
+        await asyncio.gather(*[self.hub.subscribe(self, topic) for topic in topics])
+        startup.mark(self.conf['id'], 'subscribe')
+
+        # The marker is unique, so a marker queued by the persistent
+        # session from an earlier connection isn't taken for this one
+        self.marker = os.urandom(8).hex().encode()
+        await self.publish(self.marker_topic, self.marker, qos=1)
+        if self.conf.get('coalesce'):
+            self.dispatcher.coalesce = set(self.coalesced_topics())
+
+        # Create the publisher tasks
         self.config_task = asyncio.create_task(self.config_publisher())
+        self.status_task = asyncio.create_task(self.status_publisher())
+
+    async def disconnected(self):
+        ''' Called by the hub when the MQTT connection is lost '''
+        await self.dispatcher.stop()
+        await cancel_task(self.config_task)
+        await cancel_task(self.status_task)
+        self.config_event.clear()
+
+    def subscriptions(self):
+        ''' Return the topics the device subscribes to '''
+        return [self.command_topic, self.HA_STATUS]
+
+    def retained_topics(self):
+        ''' Return the retained state and status topics of the device '''
+        return [self.state_topic, self.status_topic]
+
+    def coalesced_topics(self):
+        ''' Return the topics where only the latest unhandled message
+            matters. They are coalesced when enabled by the coalesce config.
+        '''
+        return [self.command_topic]
+
+    def merge_messages(self, old, new):
+        ''' Combine an unhandled message with a newer on the same topic '''
+        return new
+
+    def route(self, message):
+        ''' Called by the hub for every message on a subscribed topic '''
+        topic = message.topic
+        if topic == self.marker_topic:
+            # All retained messages have been received
+            if message.payload == self.marker:
+                self.retained_event.set()
+            return
+        if topic in self.watched:
+            # Retained message from the broker
+            if topic in self.encoded_configs():
+                try:
+                    digest = state.content_hash(state.loads(message.payload))
+                except ValueError:
+                    # Empty or invalid config
+                    digest = None
+            else:
+                digest = bytes(message.payload)
+            self.retained[topic] = digest
+            if len(self.retained) >= len(self.watched):
+                self.retained_event.set()
+            return
+        self.dispatcher.put(message)
+
+    async def dispatch(self, message):
+        ''' Run by the dispatcher for each received message '''
+
+        # Wait until the config has been sent
         await self.config_event.wait()
 
+        log.debug(">>> TOPIC: %s: %s", message.topic, message.payload)
+        if metrics.enabled:
+            t0 = time.perf_counter()
+            await self.handle_message(message)
+            HANDLER_TIME.observe(time.perf_counter() - t0, self.conf['id'])
+        else:
+            await self.handle_message(message)
+
     async def config_publisher(self):
 
-        print("CONFIG:")
-        pprint(self.conf["config"])
+        log.debug("CONFIG: %s", self.conf["config"])
+
+        # Wait for the retained messages from the broker, which is done
+        # when the marker returns, or when all watched topics have a
+        # retained message. The timeout is only a fallback for a lost
+        # marker.
+        try:
+            await asyncio.wait_for(self.retained_event.wait(),
+                                   self.conf.get('retained_timeout', 1))
+        except asyncio.TimeoutError:
+            log.warning("%s: Timeout waiting for the retained messages", self.conf['id'])
+        watched, self.watched = self.watched, set()
+        for topic in list(watched) + [self.marker_topic]:
+            await self.hub.unsubscribe(self, topic)
 
         # Ensure state and status are present before pushing the config
         await self.publish_state(force=True)
+        startup.mark(self.conf['id'], 'state')
         await self.publish_status(self.status, force=True)
 
-        while True:
-
-            # Publish the config
-            await self.publish_config()
-
-            # Signal that the config has been sent
-            self.config_event.set()
-
-            await asyncio.sleep(self.conf['publish_interval'])
+        # Publish the config
+        await self.publish_config()
+        startup.mark(self.conf['id'], 'config')
+
+        # Signal that the config has been sent
+        self.config_event.set()
+
+    def configs(self):
+        ''' Return the discovery configs of the device as (topic, config) '''
+        return [(self.config_topic, self.conf['config'])]
+
+    def encoded_configs(self):
+        ''' Return the encoded configs as {topic: (payload, hash)} '''
+        if self.config_cache is None:
+            self.config_cache = {
+                topic: (state.dumps(config), state.content_hash(config))
+                for topic, config in self.configs()
+            }
+        return self.config_cache
+
+    async def config_changed(self):
+        ''' Publish the configs after they have been changed '''
+        self.config_cache = None
+        await self.publish_config()
+
+    async def ha_online(self):
+        ''' Home Assistant has (re)started. It re-reads the retained
+            configs, so only the configs missing on the broker are sent.
+        '''
+        await self.publish_config()
 
     async def status_publisher(self):
 
@@ -122,44 +496,45 @@ class Hatt:
             # FIXME: Sets status to online. Should be done elsewhere?
             await self.publish_status(self.STATUS_ONLINE)
 
-            await asyncio.sleep(self.conf['status_interval'])
-
-    async def message_handler(self, messages):
-
-        # Wait until the config has been sent
-        await self.config_event.wait()
-
-        # Loop over the subscriptions
-        async for message in messages:
-            topic = message.topic
-            payload = message.payload
+            await asyncio.sleep(self.conf.get('status_interval', 60))
 
-            print(f">>> TOPIC: {topic}")
-            print(f"    PAYLOAD: {payload}")
-
-            if topic == self.HA_STATUS and payload == b'online':
-                await self.restart_config_publisher()
+    async def handle_message(self, message):
+        ''' Handle a received message. Messages on the same topic are
+            handled in order, and messages on other topics concurrently.
+        '''
+        if message.topic == self.HA_STATUS and message.payload == b'online':
+            await self.ha_online()
 
     async def publish(self, topic, payload, **kwargs):
-        print(f"<<< PUBLISH: {topic}")
-        print(f"    PAYLOAD: {payload}")
-        return await self.mqtt.publish(topic, payload, **kwargs)
+        return await self.hub.publish(topic, payload, **kwargs)
 
     async def publish_config(self):
-        return await self.publish(
-            self.config_topic, json.dumps(self.conf['config']), retain=True, qos=2
-        )
+        ''' Publish the configs that differ from the retained configs '''
+        for topic, (payload, digest) in self.encoded_configs().items():
+            if self.retained.get(topic) == digest:
+                log.debug("Config %s is unchanged", topic)
+                continue
+            await self.publish(topic, payload, retain=True, qos=2)
+            self.retained[topic] = digest
+
+    async def publish_retained(self, topic, payload, qos=0):
+        ''' Publish a retained message, unless the broker already has it '''
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if self.retained.get(topic) == payload:
+            log.debug("%s is unchanged", topic)
+            return
+        await self.publish(topic, payload, retain=True, qos=qos)
+        self.retained[topic] = payload
 
     async def publish_status(self, status=STATUS_OFFLINE, force=False):
+        if status == self.STATUS_ONLINE:
+            startup.mark(self.conf['id'], 'online')
         if force or self.status != status:
             self.status = status
-            return await self.publish(
-                self.status_topic, status, retain=True, qos=2
-            )
+            return await self.publish_retained(self.status_topic, status, qos=2)
 
     async def publish_state(self, force=False):
-        if force or self.state != self.laststate:
-            self.laststate = self.state.copy()
-            return await self.publish(
-                self.state_topic, json.dumps(self.state), retain=True
-            )
+        if force or self.state.dirty:
+            self.state.dirty = False
+            return await self.publish_retained(self.state_topic, self.state.encode())
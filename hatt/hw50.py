@@ -1,11 +1,22 @@
 import asyncio
-import serial_asyncio
+import functools
+import logging
+import struct
+import time
 import serial
-from queue import Queue
-import asyncio_mqtt as mqtt
-from pprint import pprint
 
 from . import hatt
+from . import metrics
+from . import state
+from .serialport import SerialPort
+
+
+log = logging.getLogger(__name__)
+
+ROUNDTRIP = metrics.Histogram('hatt_hw50_roundtrip_seconds',
+                              'Time from HW50 command to reply', ('item',))
+TIMEOUTS = metrics.Counter('hatt_hw50_timeouts_total', 'HW50 command timeouts', ('item',))
+NAKS = metrics.Counter('hatt_hw50_naks_total', 'HW50 commands rejected with NAK', ('item',))
 
 
 # HW50 Protocol
@@ -21,9 +32,12 @@ from . import hatt
 #     B7: EOF 0x9A
 
 # FRAMING
+BAUDRATE = 38500
+BITS_PER_BYTE = 11  # Start, 8 data, parity and stop bits
 FRAMESIZE = 8
 SOF = 0xA9
 EOF = 0x9A
+SOF_BYTE = bytes([SOF])
 
 # REQUEST/RESPONSE TYPES
 SET_RQ = 0x00
@@ -133,6 +147,19 @@ IR_MUTE = IRCMD | 0x24
 IR_STATUSON = IRCMD | 0x25
 IR_STATUSOFF = IRCMD | 0x26
 
+# Items which can be both read and set
+SETTINGS = (
+    CALIB_PRESET, CONTRAST, BRIGHTNESS, COLOR, HUE, SHARPNESS, COLOR_TEMP,
+    LAMP_CONTROL, CONTRAST_ENHANCER, ADVANCED_IRIS, REAL_COLOR_PROCESSING,
+    FILM_MODE, GAMMA_CORRECTION, NR, COLOR_SPACE, USER_GAIN_R, USER_GAIN_G,
+    USER_GAIN_B, USER_BIAS_R, USER_BIAS_G, USER_BIAS_B, IRIS_MANUAL,
+    FILM_PROJECTION, MOTION_ENHANCER, XV_COLOR, REALITY_CREATION,
+    RC_RESOLUTION, RC_NOISEFILTER, MPEG_NR,
+    ASPECT, OVERSCAN, SCREEN_AREA,
+    INPUT, MUTE, HDMI1_DYNRANGE, HDMI2_DYNRANGE, SETTINGS_LOCK,
+    DISPSEL_3D, FORMAT_3D, FORMAT_DEPTH, EFFECT_3D, GLASS_BRIGHTNESS,
+)
+
 # LIST OF ALL ITEMS
 ITEMS = {
     STATUS_ERROR: "Status Error",
@@ -226,28 +253,37 @@ class CommandError(Exception):
     pass
 
 
+# COMMAND PRIORITIES
+# User commands are sent before the background status polling
+PRIORITY_USER = 0
+PRIORITY_POLL = 1
+
+# CODEC TABLES
+# Frame layout for struct: SOF, ITEM, TYPE, DATA, CHECKSUM, EOF
+FRAME = struct.Struct('>BHBHBB')
+
+# The checksum is the OR of the bytes. FOLD[x] is the OR of the two bytes
+# in the 16-bit value x.
+FOLD = bytes((x >> 8) | (x & 0xFF) for x in range(0x10000))
+
+HEX = ['%02x' % x for x in range(0x100)]
+
+
 def dump(data):
     ''' Return a printout string of data '''
-    msg = bytearray(data)
-    s = ' '.join(['%02x' %(x) for x in msg])
-    return "(%s) %s" %(len(data), s)
+    return "(%s) %s" %(len(data), ' '.join([HEX[x] for x in data]))
 
 
 def dumptext(data):
     ''' Return a HW50 frame printout as text '''
-    b = bytearray(data)
-
-    item = b[1]<<8 | b[2]
-    cmd = b[3]
-    data = b[4]<<8 | b[5]
+    _, item, cmd, data, _, _ = FRAME.unpack_from(data)
 
     s1 = TYPES.get(cmd, '???')
     s2 = ''
-    s3 = ITEMS.get(item, '???')
     if cmd == GET_RQ:
-        s2 = '%04x "%s"' %(item, s3)
+        s2 = '%04x "%s"' %(item, ITEMS.get(item, '???'))
     elif cmd in (SET_RQ, GET_RS):
-        s2 = '%04x "%s" = %04x' %(item, s3, data)
+        s2 = '%04x "%s" = %04x' %(item, ITEMS.get(item, '???'), data)
     elif cmd == ACK_RS:
         s2 = RESPONSES.get(item, '???')
     return s1 + ' ' + s2
@@ -255,208 +291,239 @@ def dumptext(data):
 
 def decode_hw50frame(frame, response_frame=True):
     ''' Decode an HW50 frame '''
-    b = bytearray(frame)
-
     if len(frame) != FRAMESIZE:
         raise FrameError("Incomplete frame")
-    if b[0] != SOF:
+
+    sof, item, cmd, data, c, eof = FRAME.unpack(frame)
+
+    if sof != SOF:
         raise FrameError("Wrong SOF field")
-    if b[7] != EOF:
+    if eof != EOF:
         raise FrameError("Wrong EOF field")
-
-    c = 0
-    for x in range(1, 6):
-        c |= b[x]
-    if b[6] != c:
+    if c != FOLD[item] | cmd | FOLD[data]:
         raise FrameError("Checksum failure")
 
-    item = b[1]<<8 | b[2]
-    cmd = b[3]
-    data = b[4]<<8 | b[5]
-
     if response_frame:
-        if cmd == ACK_RS:
-            if item not in RESPONSES:
-                raise FrameError("Unknown ACK/NAK response error")
-        elif cmd == GET_RS:
-            pass
-        else:
-            raise FrameError("Unknown response type")
+        check_response(item, cmd)
 
     return (item, cmd, data)
 
 
-def encode_hw50frame(item, cmd, data):
-    ''' Return an encoded frame '''
-    b = bytearray(b"\x00" * FRAMESIZE)
+def decode_hw50frames(buf, response_frame=True):
+    ''' Decode a buffer of consecutive HW50 frames. Returns a list of
+        (item, cmd, data)
+    '''
+    if len(buf) % FRAMESIZE:
+        raise FrameError("Incomplete frame")
 
-    b[0] = SOF
-    b[1] = (item&0xFF00)>>8
-    b[2] = (item&0xFF)
-    b[3] = cmd
-    b[4] = (data&0xFF00)>>8
-    b[5] = (data&0xFF)
+    frames = []
+    for sof, item, cmd, data, c, eof in FRAME.iter_unpack(buf):
+        if sof != SOF or eof != EOF or c != FOLD[item] | cmd | FOLD[data]:
+            raise FrameError(f"Invalid frame at offset {len(frames) * FRAMESIZE}")
+        if response_frame:
+            check_response(item, cmd)
+        frames.append((item, cmd, data))
+    return frames
 
-    c = 0
-    for x in range(1, 6):
-        c |= b[x]
-    b[6] = c
-    b[7] = EOF
 
-    return b
+def check_response(item, cmd):
+    ''' Check that a decoded frame is a valid response '''
+    if cmd == ACK_RS:
+        if item not in RESPONSES:
+            raise FrameError("Unknown ACK/NAK response error")
+    elif cmd == GET_RS:
+        pass
+    else:
+        raise FrameError("Unknown response type")
 
 
-class Hw50(asyncio.Protocol):
-    timeout = 3.5
+def pack_hw50frame(item, cmd, data):
+    ''' Return a newly encoded frame '''
+    return FRAME.pack(SOF, item, cmd, data, FOLD[item] | cmd | FOLD[data], EOF)
 
-    @classmethod
-    async def connect(cls, device):
-        loop = asyncio.get_running_loop()
-        return await serial_asyncio.create_serial_connection(loop, cls,
-            device,
-            baudrate=38500,
-            bytesize=serial.EIGHTBITS,
-            parity=serial.PARITY_EVEN,
-            stopbits=serial.STOPBITS_ONE,
-            xonxoff=False,
-            rtscts=False,
-            dsrdtr=False,
-        )
 
-    def __init__(self):
-        self.queue = Queue()
+# Pre-encoded request frames for the fixed commands
+REQUESTS = {}
+for _item in (STATUS_ERROR, STATUS_POWER, LAMP_TIMER, STATUS_ERROR2, CALIB_PRESET):
+    REQUESTS[(_item, GET_RQ, 0)] = pack_hw50frame(_item, GET_RQ, 0)
+for _item in (IR_PWRON, IR_PWROFF, IR_MUTE, IR_STATUSON, IR_STATUSOFF):
+    REQUESTS[(_item, SET_RQ, 0)] = pack_hw50frame(_item, SET_RQ, 0)
+del _item
 
-    def connection_made(self, transport):
-        self.transport = transport
-       #print('connection_made', transport)
-        self.connected = True
-        self.rxbuffer = bytearray()
-        self.lastmsg = None
 
-    def connection_lost(self, exc):
-        #print('connection_lost')
-        self.connected = False
+def encode_hw50frame(item, cmd, data):
+    ''' Return an encoded frame '''
+    frame = REQUESTS.get((item, cmd, data))
+    if frame is None:
+        frame = pack_hw50frame(item, cmd, data)
+    return frame
 
-    #def pause_writing(self):
-    #    print('pause_writing')
-    #    print(self.transport.get_write_buffer_size())
 
-    #def resume_writing(self):
-    #    print(self.transport.get_write_buffer_size())
-    #    print('resume_writing')
+def decode_status_error(status):
+    if status == STATUS_ERROR_OK:
+        return STATUS_ERRORS[STATUS_ERROR_OK]
+    return [t for s, t in STATUS_ERRORS.items() if s & status]
 
-    def data_received(self, data):
-        #print('data_received', repr(data))
 
-        #self.log.debug('{_rawin}', rawin=data)
-        msg = bytearray(data)
-        self.rxbuffer += msg
+def decode_status_power(status):
+    return STATUS_POWERS.get(status, "Uknown status")
 
-        # Search for data frames in the incoming data buffer. Search for SOF and EOF markers.
-        # It will only iterate if the buffer is large enough for a complete frame
-        buf = self.rxbuffer
-        for x in range(0, len(buf)-FRAMESIZE+1):
 
-            # Search for SOF and EOF markers
-            if buf[x] == SOF and buf[x+FRAMESIZE-1] == EOF:
+class Hw50Framer:
+    ''' Incremental HW50 frame extractor. The received data is scanned only
+        once. Frames are decoded in place in the receive buffer, and the
+        buffer is compacted once per call. Only the bytes that might start
+        a frame are retained, so junk data never accumulates.
+    '''
 
-                try:
-                    # Decode the response-frame
-                    frame = buf[x:x+FRAMESIZE]
-                    print(f"     >>>  {dump(frame)} - {dumptext(frame)}")
-                    item, cmd, data = decode_hw50frame(frame)
-
-                except FrameError as e:
-
-                    # Frame decode fails, do iteration
-                    print(f"Decode failure: {e}")
-                    continue
-
-                # Consume all data up until the frame (including pre-junk) and
-                # save the data after the frame for later processing
-                self.rxbuffer = buf[x+FRAMESIZE:]
-                if x > 0 or len(self.rxbuffer) > 0:
-                    print(f"Discarded junk in data, '{dump(buf[:x])}' before, '{dump(self.rxbuffer)}' after")
-
-                # Process the reply frame
-                if self.lastmsg:
-
-                    # Cancel the timeout task
-                    #send_item, send_cmd, _ = decode_hw50frame(self.lastmsg, response_frame=False)
-                    self.lastmsg = None
-                    self.timer.cancel()
-
-                    # Treat either A) Unknown frame type commands or
-                    #              B) ACK_RS types with non-ACK_OK responses
-                    # as errors
-                    #if cmd != send_cmd:
-                    #    self.future.set_exception(FrameError("Invalid response"))
-                    if cmd not in TYPES or (cmd == ACK_RS and item != ACK_OK):
-                        self.future.set_exception(CommandError(RESPONSES.get(item, item)))
-                    else:
-                        self.future.set_result(data)
-
-                    # Proceed to the next command
-                    self.send_next()
-                    return
-
-                # Not interested in the received message
-                print("-IGNORED-")
-
-    def send_next(self):
-        # Don't send if communication is pending
-        if self.lastmsg:
-            return
+    def __init__(self):
+        self.buffer = bytearray()
+
+        # Statistics
+        self.frames = 0
+        self.junk = 0
+        self.errors = 0
+
+    def feed(self, data):
+        ''' Add received data. Returns a list of (item, cmd, data) of the
+            complete frames found.
+        '''
+        buf = self.buffer
+        buf += data
+
+        # Fast path when waiting for the rest of a frame
+        if len(buf) < FRAMESIZE and buf[:1] == SOF_BYTE:
+            return []
+
+        unpack_from = FRAME.unpack_from
+
+        frames = []
+        pos = 0
+        last = len(buf) - FRAMESIZE
+        while pos <= last:
+            x = buf.find(SOF, pos)
+            if x < 0 or x > last:
+                break
+
+            _, item, cmd, data, c, eof = unpack_from(buf, x)
+            if eof != EOF or c != FOLD[item] | cmd | FOLD[data]:
+                # Not a frame, resume the search after the SOF
+                self.errors += 1
+                self.junk += x + 1 - pos
+                pos = x + 1
+                continue
 
-        while self.queue.qsize():
-            future, msg, item = self.queue.get(False)
+            self.junk += x - pos
+            frames.append((item, cmd, data))
+            pos = x + FRAMESIZE
 
-            # Send the command
-            print(f"     <<<  {dump(msg)} - {dumptext(msg)}")
-            self.transport.write(msg)
+        # Discard everything before the next possible frame
+        x = buf.find(SOF, pos)
+        if x < 0:
+            x = len(buf)
+        self.junk += x - pos
+        del buf[:x]
 
-            # Prepare for reply where applicable
-            ircmd = item & IRCMD_MASK
+        self.frames += len(frames)
+        return frames
 
-            # IR-commands does not reply, so they can be replied to immediately
-            # and can proceed to next command
-            if ircmd in (IRCMD, IRCMD2, IRCMD3):
-                future.set_result(None)
-                continue
 
-            # Expect reply, setup timeout and return
-            self.lastmsg = msg
-            self.future = future
-            self.timer = asyncio.create_task(self.timeout_keeper())
+def is_response(frame):
+    ''' Response matcher of the HW50 requests. Every response frame is the
+        response of the outstanding request, as the protocol has no
+        request ids.
+    '''
+    return frame[1] in (GET_RS, ACK_RS)
+
+
+class Hw50(SerialPort):
+    ''' HW50 protocol handler. Only one command is outstanding at a time.
+        Pending commands are sent in priority order, and identical pending
+        GET requests share the same reply.
+    '''
+    timeout = 3.5
+    settings = dict(
+        baudrate=BAUDRATE,
+        bytesize=serial.EIGHTBITS,
+        parity=serial.PARITY_EVEN,
+        stopbits=serial.STOPBITS_ONE,
+        xonxoff=False,
+        rtscts=False,
+        dsrdtr=False,
+    )
+    log = log
+    codec_factory = Hw50Framer
+
+    def __init__(self, capture=None, name='hw50'):
+        super().__init__(capture, name)
+
+    def data_received(self, data):
+        junk = self.codec.junk
+        super().data_received(data)
+        if self.codec.junk != junk:
+            log.debug("Discarded %s bytes of junk in data", self.codec.junk - junk)
+
+    def frame_received(self, frame):
+        item, cmd, data = frame
+        if log.isEnabledFor(logging.DEBUG):
+            msg = encode_hw50frame(item, cmd, data)
+            log.debug("     >>>  %s - %s", dump(msg), dumptext(msg))
+        try:
+            check_response(item, cmd)
+        except FrameError as e:
+            log.warning("Decode failure: %s", e)
             return
+        super().frame_received(frame)
+
+    def response(self, request, frame):
+        # ACK_RS types with non-ACK_OK responses are errors
+        item, cmd, data = frame
+        if cmd == ACK_RS and item != ACK_OK:
+            raise CommandError(RESPONSES.get(item, item))
+        return data
+
+    def describe(self, msg):
+        return f"{dump(msg)} - {dumptext(msg)}"
+
+    def command(self, item, cmd=GET_RQ, data=0x0, priority=None):
+        ''' Queue a command. Returns a future for the reply. GET requests
+            default to polling priority and other commands to user priority.
+        '''
+        if priority is None:
+            priority = PRIORITY_POLL if cmd == GET_RQ else PRIORITY_USER
+
+        # IR commands have no reply. Identical GET requests share the reply.
+        key = item if cmd == GET_RQ else None
+        shared = key in self.shared
+        future = self.request(
+            encode_hw50frame(item, cmd, data), priority, is_response,
+            reply=item & IRCMD_MASK not in (IRCMD, IRCMD2, IRCMD3), key=key,
+        )
 
-    async def timeout_keeper(self):
-        await asyncio.sleep(self.timeout)
-        # The timeout response is to fail the request and proceed with the next command
-        print(f"Command {dumptext(self.lastmsg)} timed out")
-        self.lastmsg = None
-        self.future.set_exception(TimeoutError())
-        self.send_next()
-
-    def command(self, item, cmd=GET_RQ, data=0x0):
-        # Compile next request
-        msg = encode_hw50frame(item, cmd, data)
-        future = asyncio.get_running_loop().create_future()
-        self.queue.put((future, msg, item))
-        self.send_next()
+        if metrics.enabled and not shared:
+            future.add_done_callback(functools.partial(
+                self._observe, '%04x' % item, time.perf_counter()))
         return future
 
+    @staticmethod
+    def _observe(item, t0, future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if isinstance(exc, TimeoutError):
+            TIMEOUTS.inc(item)
+        elif isinstance(exc, CommandError):
+            NAKS.inc(item)
+        elif exc is None:
+            ROUNDTRIP.observe(time.perf_counter() - t0, item)
+
     # -- Composite commands --
 
     async def get_status_error(self):
-        status = await self.command(STATUS_ERROR)
-        if status == STATUS_ERROR_OK:
-            return STATUS_ERRORS[STATUS_ERROR_OK]
-        return [t for s, t in STATUS_ERRORS.items() if s & status]
+        return decode_status_error(await self.command(STATUS_ERROR))
 
     async def get_status_power(self):
-        status = await self.command(STATUS_POWER)
-        return STATUS_POWERS.get(status, "Uknown status")
+        return decode_status_power(await self.command(STATUS_POWER))
 
     async def power_on(self):
         await self.command(IR_PWRON, cmd=SET_RQ)
@@ -465,57 +532,77 @@ class Hw50(asyncio.Protocol):
         await self.command(IR_PWROFF, cmd=SET_RQ)
 
 
-class Hw50Emulator:
-
-    def __init__(self, protocol):
-        self.protocol = protocol
-        self.power = STATUS_POWER_STANDBY
-        protocol.connection_made(self)
-
-    def reply(self, item, cmd, data, delay=0.1):
-        async def send(msg):
-            await asyncio.sleep(delay)
-            print(f"HW50 RX:  {dump(msg)}")
-            self.protocol.data_received(msg)
-        asyncio.create_task(send(encode_hw50frame(item, cmd, data)))
-
-    def write(self, msg):
-        print(f"HW50 TX:  {dump(msg)}")
-        item, cmd, data = decode_hw50frame(msg, response_frame=False)
-
-        if item == STATUS_POWER:
-            self.reply(item, GET_RS, self.power)
-        elif item == STATUS_ERROR:
-            self.reply(item, GET_RS, STATUS_ERROR_OK)
-        elif item == STATUS_ERROR2:
-            self.reply(item, GET_RS, STATUS_ERROR2_OK)
-        elif item == LAMP_TIMER:
-            self.reply(item, GET_RS, 100)
-        elif item == IR_PWRON:
-            asyncio.create_task(self.poweron())
-        elif item == IR_PWROFF:
-            asyncio.create_task(self.poweroff())
-        else:
-            self.reply(NAK_UNKNOWNCOMMAND, ACK_RS, 0)
-
-    async def poweron(self):
-        self.power = STATUS_POWER_STARTUPLAMP
-        await asyncio.sleep(5)
-        self.power = STATUS_POWER_POWERON
-
-    async def poweroff(self):
-        self.power = STATUS_POWER_COOLING1
-        await asyncio.sleep(5)
-        self.power = STATUS_POWER_COOLING2
-        await asyncio.sleep(5)
-        self.power = STATUS_POWER_STANDBY
+# Power states where the projector is changing state
+POWER_TRANSITIONS = {
+    STATUS_POWERS[p] for p in (
+        STATUS_POWER_STARTUP,
+        STATUS_POWER_STARTUPLAMP,
+        STATUS_POWER_COOLING1,
+        STATUS_POWER_COOLING2,
+        STATUS_POWER_SAVINGCOOLING1,
+        STATUS_POWER_SAVINGCOOLING2,
+    )
+}
+
+
+class Poll:
+    ''' Polling of one HW50 item. The item is polled every interval
+        seconds, or every fast_interval seconds when fast(state) is true.
+        update(state, value) stores the polled value in the state.
+    '''
+
+    def __init__(self, name, item, interval, update, fast_interval=None, fast=None):
+        self.name = name
+        self.item = item
+        self.interval = interval
+        self.update = update
+        self.fast_interval = fast_interval
+        self.fast = fast
+        self.due = 0
+
+    def next_interval(self, state):
+        if self.fast_interval and self.fast and self.fast(state):
+            return self.fast_interval
+        return self.interval
+
+
+def _update_power(state, value):
+    power = decode_status_power(value)
+    state['power_state'] = power
+    if power in (
+        STATUS_POWERS[STATUS_POWER_STANDBY],
+        STATUS_POWERS[STATUS_POWER_SAVINGSTANDBY],
+    ):
+        state['state'] = 'OFF'
+    if power in (
+        STATUS_POWERS[STATUS_POWER_POWERON],
+    ):
+        state['state'] = 'ON'
+
+
+def _update_error(state, value):
+    state['status'] = decode_status_error(value)
+
+
+def _update_lamp_timer(state, value):
+    state['lamp_timer'] = value
 
 
+# Default polling schedule. The intervals can be changed with the "poll"
+# config, e.g. {"power": 30, "lamp_timer": 7200}
+POLLS = (
+    # name, item, interval, update, fast_interval, fast
+    ('power', STATUS_POWER, 60, _update_power, 1,
+     lambda state: state['power_state'] in POWER_TRANSITIONS),
+    ('error', STATUS_ERROR, 60, _update_error, None, None),
+    ('lamp_timer', LAMP_TIMER, 3600, _update_lamp_timer, None, None),
+)
+
 
 class Hw50Hatt(hatt.Hatt):
 
-    def __init__(self, conf, hw50):
-        super().__init__(conf)
+    def __init__(self, conf, hub, hw50):
+        super().__init__(conf, hub)
 
         self.hw50 = hw50
 
@@ -526,124 +613,128 @@ class Hw50Hatt(hatt.Hatt):
             "device": conf['device'],
             "unique_id": conf['unique_id'],
             "command_topic": f"~/{self.COMMAND_TOPIC}",
-            "availability_topic": f"~/{self.STATUS_TOPIC}",
+            "qos": 1,
+            "availability": self.availability,
+            "availability_mode": "all",
             "state_topic": f"~/{self.STATE_TOPIC}",
             "json_attributes_topic": f"~/{self.STATE_TOPIC}",
             "value_template": "{{ value_json.state }}",
         }
 
-        self.state = {
+        self.state = state.State({
             "power_state": "Unknown",
             "status": "Unknown",
             "state": "OFF",
             "lamp_timer": 0,
-        }
+            "bus_utilization": 0,
+        })
         self.queue = asyncio.Queue()
 
-    async def message_handler(self, messages):
-
-        # Wait until the config has been sent
-        await self.config_event.wait()
-
-        # Loop over the subscriptions
-        async for message in messages:
-            topic = message.topic
-            payload = message.payload
-
-            print(f">>> TOPIC: {topic}")
-            print(f"    PAYLOAD: {payload}")
-
-            if topic == self.HA_STATUS and payload == b'online':
-                await self.restart_config_publisher()
-
-            if topic == self.command_topic:
-                state = self.state['state']
+        # The polling schedule. status_interval is the power poll interval
+        intervals = {'power': conf.get('status_interval', 60)}
+        intervals.update(conf.get('poll', {}))
+        self.polls = []
+        for name, item, interval, update, fast_interval, fast in POLLS:
+            self.polls.append(Poll(name, item, intervals.get(name, interval),
+                                   update, fast_interval, fast))
 
-                if payload == b'ON' and state == 'OFF':
+        log.info("%s: Polling uses %s%% of the serial bus", conf['id'], self.bus_utilization())
 
-                    self.state['state'] = 'ON'
-                    await self.hw50.power_on()
-                    await asyncio.sleep(1)
-                    await self.queue.put(None)
+    async def handle_message(self, message):
+        await super().handle_message(message)
 
-                elif payload == b'OFF' and state == 'ON':
-
-                    self.state['state'] = 'OFF'
-                    await self.hw50.power_off()
-                    await asyncio.sleep(1)
-                    await self.queue.put(None)
+        if message.topic == self.command_topic:
+            payload = message.payload
+            state = self.state['state']
+
+            if payload == b'ON' and state == 'OFF':
+                self.state['state'] = 'ON'
+                await self.hw50.power_on()
+                self.repoll_power()
+
+            elif payload == b'OFF' and state == 'ON':
+                self.state['state'] = 'OFF'
+                await self.hw50.power_off()
+                self.repoll_power()
+
+    def repoll_power(self):
+        ''' Poll the power state when the projector has had time to react
+            to a command
+        '''
+        asyncio.get_running_loop().call_later(1, self.queue.put_nowait, None)
+
+    def bus_utilization(self):
+        ''' Return the serial bus utilization of the current polling
+            schedule in percent
+        '''
+        frametime = 2 * FRAMESIZE * BITS_PER_BYTE / BAUDRATE
+        return round(sum(
+            frametime / poll.next_interval(self.state) for poll in self.polls
+        ) * 100, 3)
 
     async def status_publisher(self):
 
         # Wait until the config has been sent
         await self.config_event.wait()
 
-        while True:
-            try:
-                interval = self.conf['status_interval']
-                do_full_status = True
-
-                power = await self.hw50.get_status_power()
-
-                if power not in (
-                    STATUS_POWERS[STATUS_POWER_STANDBY],
-                    STATUS_POWERS[STATUS_POWER_SAVINGSTANDBY],
-                    STATUS_POWERS[STATUS_POWER_POWERON],
-                ):
-                    interval = 1
-                    do_full_status = False
-
-                self.state['power_state'] = power
-                if power in (
-                    STATUS_POWERS[STATUS_POWER_STANDBY],
-                    STATUS_POWERS[STATUS_POWER_SAVINGSTANDBY],
-                ):
-                    self.state['state'] = 'OFF'
-                if power in (
-                    STATUS_POWERS[STATUS_POWER_POWERON],
-                ):
-                    self.state['state'] = 'ON'
-
-                if do_full_status:
-                    status = await self.hw50.get_status_error()
-                    self.state['status'] = status
-
-                    lamp = await self.hw50.command(LAMP_TIMER)
-                    self.state['lamp_timer'] = lamp
-
-                await self.publish_status(self.STATUS_ONLINE)
-
-            except TimeoutError:
-                await self.publish_status(self.STATUS_OFFLINE)
+        loop = asyncio.get_running_loop()
 
-            finally:
-                await self.publish_state()
+        while True:
+            now = loop.time()
+            due = [poll for poll in self.polls if poll.due <= now]
 
+            if due:
+                try:
+                    for poll in due:
+                        try:
+                            value = await self.hw50.command(poll.item)
+                            poll.update(self.state, value)
+                        except CommandError as e:
+                            log.warning("Polling %s failed: %s", poll.name, e)
+                        poll.due = now + poll.next_interval(self.state)
+
+                    await self.publish_status(self.STATUS_ONLINE)
+
+                except (TimeoutError, ConnectionError):
+                    # The projector doesn't answer, or the serial port
+                    # is gone
+                    for poll in due:
+                        poll.due = now + poll.next_interval(self.state)
+                    await self.publish_status(self.STATUS_OFFLINE)
+
+                finally:
+                    self.state['bus_utilization'] = self.bus_utilization()
+                    await self.publish_state()
+
+            # Wait until the next poll is due, or a command requests an
+            # immediate update of the power state
+            interval = min(poll.due for poll in self.polls) - loop.time()
             try:
-                await asyncio.wait_for(self.queue.get(), interval)
+                await asyncio.wait_for(self.queue.get(), max(interval, 0))
+                for poll in self.polls:
+                    if poll.item == STATUS_POWER:
+                        poll.due = 0
             except asyncio.TimeoutError:
                 pass
 
 
-async def main(conf):
-    print(f"{conf['id']}: Running hw50 device")
-
-    # Open protocol handler
-    _, hw50 = await Hw50.connect(conf['port'])
-
-    # Protocol testing
-    #hw50 = Hw50()
-    #Hw50Emulator(hw50)
-
-    reconnect = False
-    reconnect_interval = conf['reconnect_interval']
-    while True:
-        try:
-            if reconnect:
-                await asyncio.sleep(reconnect_interval)
-
-            await Hw50Hatt(conf, hw50).main()
-
-        except mqtt.MqttError as error:
-            print(f'Error "{error}". Reconnecting in {reconnect_interval} seconds.')
-            reconnect = True
+async def main(conf, hub):
+    log.info("%s: Running hw50 device", conf['id'])
+
+    emulate = conf.get('emulate')
+    if emulate:
+        # Emulated projector for testing. The emulator options can be
+        # given as a dict
+        from .hw50emu import Hw50Emulator
+        hw50 = Hw50(conf.get('capture'))
+        Hw50Emulator(hw50, **(emulate if isinstance(emulate, dict) else {}))
+    else:
+        # Open protocol handler
+        _, hw50 = await Hw50.connect(conf['port'], conf.get('capture'))
+    hw50.retries = conf.get('retries', 0)
+
+    try:
+        await Hw50Hatt(conf, hub, hw50).main()
+    finally:
+        # Release the serial port when the device is stopped
+        hw50.transport.close()
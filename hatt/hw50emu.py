@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+import random
+import tty
+import serial
+
+from .hw50 import (
+    Hw50Framer, dump, encode_hw50frame, BAUDRATE, BITS_PER_BYTE, SETTINGS,
+    GET_RQ, SET_RQ, GET_RS, ACK_RS, ACK_OK, NAK_UNKNOWNCOMMAND, NAK_NA,
+    NAK_CHECKSUM, NAK_FRAMINGERR, NAK_PARITYERR, NAK_OVERRUN, NAK_OTHERERR,
+    STATUS_POWER, STATUS_ERROR, STATUS_ERROR2, LAMP_TIMER, STATUS_ERROR_OK,
+    STATUS_ERROR2_OK, IRCMD, IRCMD2, IRCMD3, IRCMD_MASK, IR_PWRON, IR_PWROFF,
+    STATUS_POWER_STANDBY, STATUS_POWER_SAVINGSTANDBY, STATUS_POWER_STARTUPLAMP,
+    STATUS_POWER_POWERON, STATUS_POWER_COOLING1, STATUS_POWER_COOLING2,
+)
+
+
+log = logging.getLogger(__name__)
+
+# NAKs used for fault injection
+INJECTED_NAKS = (NAK_CHECKSUM, NAK_FRAMINGERR, NAK_PARITYERR, NAK_OVERRUN, NAK_OTHERERR)
+
+
+class Hw50Emulator:
+    ''' Emulated projector for testing without the hardware. Without a
+        protocol, the emulator must be connected by a subclass, such as
+        Hw50PtyEmulator.
+
+        delay: Seconds from a request until the reply starts
+        transition: Seconds per step of the power transitions
+        jitter: Random extra reply delay of up to jitter seconds
+        baudrate: Send the replies one byte at a time at the baudrate.
+                  Without it, each reply is sent at once.
+        drop: Probability of not replying to a request
+        junk: Probability of sending 1-8 junk bytes before a reply
+        nak: Probability of replying with a NAK
+        items: Extra readable and settable items, as {item: value}
+        seed: Seed of the fault injection
+    '''
+
+    def __init__(self, protocol=None, delay=0.1, transition=5, jitter=0,
+                 baudrate=None, drop=0, junk=0, nak=0, items=None, seed=None):
+        self.protocol = protocol
+        self.delay = delay
+        self.transition = transition
+        self.jitter = jitter
+        self.bytetime = BITS_PER_BYTE / baudrate if baudrate else 0
+        self.drop = drop
+        self.junk = junk
+        self.nak = nak
+        self.random = random.Random(seed)
+
+        self.power = STATUS_POWER_STANDBY
+        self.power_task = None
+        self.items = dict.fromkeys(SETTINGS, 0)
+        self.items.update(items or {})
+        self.framer = Hw50Framer()
+
+        # The time when the reply line is free
+        self.line_free = 0
+
+        # Statistics
+        self.requests = 0
+        self.replies = 0
+        self.dropped = 0
+        self.naks = 0
+        self.junkbytes = 0
+
+        if protocol:
+            protocol.connection_made(self)
+
+    # -- Transport interface when connected directly to the protocol --
+
+    def write(self, data):
+        self.data_received(data)
+
+    def output(self, data):
+        ''' Send reply data to the host '''
+        self.protocol.data_received(data)
+
+    def close(self):
+        if self.power_task:
+            self.power_task.cancel()
+        if self.protocol:
+            self.protocol.connection_lost(None)
+
+    # -- Emulation --
+
+    def data_received(self, data):
+        for item, cmd, value in self.framer.feed(data):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("HW50 TX:  %s", dump(encode_hw50frame(item, cmd, value)))
+            self.requests += 1
+            self.request(item, cmd, value)
+
+    def request(self, item, cmd, data):
+        if item & IRCMD_MASK in (IRCMD, IRCMD2, IRCMD3):
+            # IR commands have no reply
+            if item == IR_PWRON and self.power in (STATUS_POWER_STANDBY,
+                                                   STATUS_POWER_SAVINGSTANDBY):
+                self.set_power(self.poweron())
+            elif item == IR_PWROFF and self.power == STATUS_POWER_POWERON:
+                self.set_power(self.poweroff())
+            return
+
+        if cmd == GET_RQ:
+            if item == STATUS_POWER:
+                self.reply(item, GET_RS, self.power)
+            elif item == STATUS_ERROR:
+                self.reply(item, GET_RS, STATUS_ERROR_OK)
+            elif item == STATUS_ERROR2:
+                self.reply(item, GET_RS, STATUS_ERROR2_OK)
+            elif item == LAMP_TIMER:
+                self.reply(item, GET_RS, 100)
+            elif item in self.items:
+                self.reply(item, GET_RS, self.items[item])
+            else:
+                self.reply(NAK_UNKNOWNCOMMAND, ACK_RS, 0)
+
+        elif cmd == SET_RQ:
+            if item in self.items:
+                self.items[item] = data
+                self.reply(ACK_OK, ACK_RS, 0)
+            elif item in (STATUS_POWER, STATUS_ERROR, STATUS_ERROR2, LAMP_TIMER):
+                self.reply(NAK_NA, ACK_RS, 0)
+            else:
+                self.reply(NAK_UNKNOWNCOMMAND, ACK_RS, 0)
+
+        else:
+            self.reply(NAK_UNKNOWNCOMMAND, ACK_RS, 0)
+
+    def reply(self, item, cmd, data):
+        rand = self.random.random
+        if self.drop and rand() < self.drop:
+            self.dropped += 1
+            return
+        if self.nak and rand() < self.nak:
+            self.naks += 1
+            item, cmd, data = self.random.choice(INJECTED_NAKS), ACK_RS, 0
+
+        msg = encode_hw50frame(item, cmd, data)
+        if self.junk and rand() < self.junk:
+            junk = bytes(self.random.randrange(0x100) for _ in range(self.random.randint(1, 8)))
+            self.junkbytes += len(junk)
+            msg = junk + msg
+
+        self.replies += 1
+        self.send(msg, self.delay + (self.jitter * rand() if self.jitter else 0))
+
+    def send(self, msg, delay):
+        ''' Send msg after delay. With a baudrate, the bytes are sent one at
+            a time, and replies queue up behind each other on the line.
+        '''
+        loop = asyncio.get_running_loop()
+        start = max(loop.time() + delay, self.line_free)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("HW50 RX:  %s", dump(msg))
+        if not self.bytetime:
+            loop.call_at(start, self.output, msg)
+            return
+        for i in range(len(msg)):
+            loop.call_at(start + (i + 1) * self.bytetime, self.output, msg[i:i+1])
+        self.line_free = start + len(msg) * self.bytetime
+
+    def set_power(self, coro):
+        if self.power_task:
+            self.power_task.cancel()
+        self.power_task = asyncio.create_task(coro)
+
+    async def poweron(self):
+        self.power = STATUS_POWER_STARTUPLAMP
+        await asyncio.sleep(self.transition)
+        self.power = STATUS_POWER_POWERON
+
+    async def poweroff(self):
+        self.power = STATUS_POWER_COOLING1
+        await asyncio.sleep(self.transition)
+        self.power = STATUS_POWER_COOLING2
+        await asyncio.sleep(self.transition)
+        self.power = STATUS_POWER_STANDBY
+
+
+class Hw50PtyEmulator(Hw50Emulator):
+    ''' Emulator served on a pseudo-terminal, so the host connects through
+        the real serial port path with
+        Hw50.connect(emulator.path, **emulator.serial_settings). Takes the
+        same options as Hw50Emulator.
+    '''
+
+    # Linux ptys reject parity settings
+    serial_settings = {'parity': serial.PARITY_NONE}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.master, self.slave = os.openpty()
+        # No echo or line editing until the host configures the port
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        asyncio.get_running_loop().add_reader(self.master, self._read)
+
+    def _read(self):
+        try:
+            data = os.read(self.master, 1024)
+        except OSError:
+            return
+        self.data_received(data)
+
+    def output(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError as e:
+            log.warning("Failed to write to pty: %s", e)
+
+    def close(self):
+        super().close()
+        asyncio.get_running_loop().remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+async def _serve(opts):
+    emulator = Hw50PtyEmulator(
+        delay=opts.delay, transition=opts.transition, jitter=opts.jitter,
+        baudrate=opts.baudrate, drop=opts.drop, junk=opts.junk, nak=opts.nak,
+        seed=opts.seed,
+    )
+    print(emulator.path, flush=True)
+    log.info("HW50 emulator on %s", emulator.path)
+    try:
+        await asyncio.get_running_loop().create_future()
+    finally:
+        emulator.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog='hatt.hw50emu',
+                                     description='HW50 projector emulator on a pseudo-terminal')
+    parser.add_argument('--delay', type=float, default=0.02, help='Reply delay. Default 0.02')
+    parser.add_argument('--transition', type=float, default=5, help='Power transition step time. Default 5')
+    parser.add_argument('--jitter', type=float, default=0, help='Random extra reply delay')
+    parser.add_argument('--baudrate', type=int, default=BAUDRATE, help=f'Default {BAUDRATE}. 0 disables the byte timing')
+    parser.add_argument('--drop', type=float, default=0, help='Probability of dropped replies')
+    parser.add_argument('--junk', type=float, default=0, help='Probability of junk before replies')
+    parser.add_argument('--nak', type=float, default=0, help='Probability of NAK replies')
+    parser.add_argument('--seed', type=int)
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_serve(opts))
+    except KeyboardInterrupt:
+        pass
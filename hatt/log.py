@@ -0,0 +1,43 @@
+import logging
+import logging.handlers
+import queue
+
+
+FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+# Format showing the worker process of the records
+WORKER_FORMAT = "%(asctime)s %(levelname)-7s [%(processName)s] %(name)s: %(message)s"
+
+
+def setup_logging(conf, level=None, handler=None):
+    ''' Configure logging from the config.
+
+        log_level: Level of the root logger. Default INFO
+        log_levels: Levels of individual loggers, e.g. {"hatt.hw50": "DEBUG"}
+        log_format: Log record format
+        log_queue: Hand the log records to a background thread, so that
+                   log output never blocks the event loop. Default false
+
+        The log is written to stderr, unless another handler is given.
+        Returns the queue listener when log_queue is enabled. It must be
+        stopped on exit to flush the log.
+    '''
+    if not handler:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(conf.get('log_format', FORMAT)))
+
+    root = logging.getLogger()
+    root.setLevel((level or conf.get('log_level', 'INFO')).upper())
+    for name, lvl in conf.get('log_levels', {}).items():
+        logging.getLogger(name).setLevel(lvl.upper())
+
+    if not conf.get('log_queue', False):
+        root.addHandler(handler)
+        return None
+
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, handler,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
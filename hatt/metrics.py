@@ -0,0 +1,205 @@
+import asyncio
+import bisect
+import functools
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+# Metrics are only collected when enabled. Instrumented code checks this
+# flag before doing any work, so disabled metrics cost one global lookup.
+enabled = False
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, doc, labels=(), register=True):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        if register:
+            REGISTRY.append(self)
+
+    def snapshot(self):
+        return (self.TYPE, self.name, self.doc, self.labels, None, self.values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.TYPE}"]
+        for labels, value in sorted(self.values.items()):
+            lines += self.render_value(labels, value)
+        return lines
+
+    def render_value(self, labels, value):
+        return [f"{self.name}{_labels(self.labels, labels)} {value}"]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS, register=True):
+        super().__init__(name, doc, labels, register)
+        self.buckets = tuple(buckets)
+
+    def snapshot(self):
+        return (self.TYPE, self.name, self.doc, self.labels, self.buckets, self.values)
+
+    def observe(self, value, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            # Bucket counts, followed by the sum and the count
+            data = self.values[labels] = [0] * (len(self.buckets) + 2)
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render_value(self, labels, data):
+        lines = []
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), data):
+            total += count
+            bucket = _labels(self.labels, labels, 'le="%s"' % le)
+            lines.append(f"{self.name}_bucket{bucket} {total}")
+        lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {data[-2]}")
+        lines.append(f"{self.name}_count{_labels(self.labels, labels)} {data[-1]}")
+        return lines
+
+
+TYPES = {cls.TYPE: cls for cls in (Counter, Gauge, Histogram)}
+
+
+def snapshot():
+    ''' Return the metrics of this process as picklable data, so they can
+        be merged and rendered by another process
+    '''
+    return [metric.snapshot() for metric in REGISTRY]
+
+
+def merge(snapshots):
+    ''' Merge the snapshots of several processes into one. Counters and
+        histograms are summed, and gauges keep the last value.
+    '''
+    merged = {}
+    for snap in snapshots:
+        for mtype, name, doc, labels, buckets, values in snap:
+            entry = merged.get(name)
+            if entry is None:
+                entry = merged[name] = (mtype, name, doc, labels, buckets, {})
+            total = entry[5]
+            for key, value in values.items():
+                if mtype == 'histogram':
+                    if key in total:
+                        value = [a + b for a, b in zip(total[key], value)]
+                    else:
+                        value = list(value)
+                elif mtype == 'counter':
+                    value += total.get(key, 0)
+                total[key] = value
+    return list(merged.values())
+
+
+def render(snap=None):
+    ''' Return the metrics of this process, or of a snapshot, in the
+        Prometheus text format
+    '''
+    if snap is None:
+        metrics = REGISTRY
+    else:
+        metrics = []
+        for mtype, name, doc, labels, buckets, values in snap:
+            if mtype == 'histogram':
+                metric = Histogram(name, doc, labels, buckets, register=False)
+            else:
+                metric = TYPES[mtype](name, doc, labels, register=False)
+            metric.values = values
+            metrics.append(metric)
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+LOOP_LAG = Histogram('hatt_event_loop_lag_seconds',
+                     'Delay of the event loop in running scheduled callbacks')
+
+
+async def loop_lag_monitor(interval=0.5):
+    ''' Measure how late the event loop wakes up from sleep '''
+    loop = asyncio.get_running_loop()
+    while True:
+        due = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - due, 0))
+
+
+async def _handle_http(collect, reader, writer):
+    try:
+        request = await reader.readline()
+        # Skip the request headers
+        while (await reader.readline()).strip():
+            pass
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1] in (b'/', b'/metrics'):
+            status, body = "200 OK", collect().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(conf, collect=render):
+    ''' Serve the metrics over HTTP until cancelled. The metrics must be
+        enabled before the instrumented code starts. collect() returns the
+        metrics text to serve.
+
+        host: Address to listen on. Default 127.0.0.1
+        port: Port to listen on. Default 9100
+    '''
+    host = conf.get('host', '127.0.0.1')
+    port = conf.get('port', 9100)
+    server = await asyncio.start_server(functools.partial(_handle_http, collect), host, port)
+    log.info("Serving metrics on http://%s:%s/metrics", host, port)
+    async with server:
+        await asyncio.gather(server.serve_forever(), loop_lag_monitor())
@@ -1,116 +1,369 @@
-import json
-import array
 import asyncio
+import logging
 import asyncio_mqtt as mqtt
-from ola.OlaClient import OlaClient
-from pprint import pprint
 
 from . import hatt
+from . import olad
+from . import dmx
+from . import dmxnet
+from . import state
 
 
-class Array:
-    ''' Hack as ola relies on calling array.array().tostring()
-        which recent py doesn't support
-    '''
-    def __init__(self, data):
-        self.d = data
-    def tostring(self):
-        return array.array("B", self.d).tobytes()
+log = logging.getLogger(__name__)
 
 
-class OlaHatt(hatt.Hatt):
+STATE_VARS = ("color", "brightness", "white_value", "state")
+
+
+class Fixture:
+    ''' A DMX fixture exposed as a HA light entity '''
+
+    def __init__(self, device, fid, conf):
+        self.id = fid
+        self.topic = conf['topic']
+        self.config_topic = f"{self.topic}/{device.CONFIG_TOPIC}"
+        self.command_topic = f"{self.topic}/{device.COMMAND_TOPIC}"
+        self.state_topic = f"{self.topic}/{device.STATE_TOPIC}"
+
+        # The layout and address are checked by the config validation
+        self.channels = dmx.channel_layout(conf.get('channels', 'rgbw'))
 
-    def __init__(self, conf):
-        super().__init__(conf)
+        # DMX addresses are 1-based in the config
+        self.address = conf.get('address', 1) - 1
+        self.universe = device.get_universe(conf.get('universe', 0))
+
+        rgb = 'r' in self.channels
+        white = 'w' in self.channels
 
         # MQTT DISCOVERY TOPIC
-        conf["config"] = {
-            "~": conf['topic'],
+        self.config = {
+            "~": self.topic,
             "name": conf['name'],
-            "device": conf['device'],
+            "device": device.conf['device'],
             "unique_id": conf['unique_id'],
-            "command_topic": f"~/{self.COMMAND_TOPIC}",
-            "state_topic": f"~/{self.STATE_TOPIC}",
-            "availability_topic": f"~/{self.STATUS_TOPIC}",
+            "command_topic": f"~/{device.COMMAND_TOPIC}",
+            "state_topic": f"~/{device.STATE_TOPIC}",
+            # HA publishes the commands with QoS 1, so they are queued
+            # by the broker while hatt is disconnected
+            "qos": 1,
+            "availability": device.availability,
+            "availability_mode": "all",
             "schema": "json",
-            "rgb": True,
-            "white_value": True,
+            "rgb": rgb,
+            "white_value": white,
             "brightness": True,
             "color_temp": False
             #"color_mode": True,
             #"supported_color_modes": ["rgbw"]
         }
 
-        self.state = {
-            "color": {"r": 0, "g": 0, "b": 0},
+        self.state = state.State({
             "brightness": 0,
-            "white_value": 0,
             "state": "OFF",
-        }
+        })
+        if rgb:
+            self.state["color"] = {"r": 0, "g": 0, "b": 0}
+        if white:
+            self.state["white_value"] = 0
 
-    async def message_handler(self, messages):
+        # The own state while the state shows the DMX of someone else
+        self.external = None
 
-        # Wait until the config has been sent
-        await self.config_event.wait()
+    def command(self, data):
+        ''' Copy the select vars from the data to the local state '''
+        self.external = None
+        for var in STATE_VARS:
+            if var in data and var in self.state:
+                self.state[var] = data[var]
 
-        # Loop over the subscriptions
-        async for message in messages:
-            topic = message.topic
-            payload = message.payload
+    def render(self):
+        ''' Return the DMX channel values for the current state '''
+        state = self.state
 
-            print(f">>> TOPIC: {topic}")
-            print(f"    PAYLOAD: {payload}")
+        # Default everything off
+        if state["state"] != "ON":
+            return [0] * len(self.channels)
 
-            if topic == self.HA_STATUS and payload == b"online":
-                await self.restart_config_publisher()
+        color = state.get("color", {})
+        r = int(color.get("r", 0))
+        g = int(color.get("g", 0))
+        b = int(color.get("b", 0))
+        w = int(state.get("white_value", 0))
+        y = int(state["brightness"]) / 255
 
-            if topic == self.command_topic:
-                state = self.state
-                data = json.loads(payload)
+        # If brightness is set but no color, set it to pure white
+        if y > 0 and r == 0 and g == 0 and b == 0:
+            r = g = b = 255
 
-                # Copy the select vars from the data to the local state
-                for var in ("color", "brightness", "white_value", "state"):
-                    if var in data:
-                        state[var] = data[var]
+        # Scale the colors by the brightness, unless the fixture has a
+        # dimmer channel of its own
+        d = int(state["brightness"])
+        if 'd' not in self.channels:
+            r, g, b = int(r * y), int(g * y), int(b * y)
 
-                print(f"    STATE: {state}")
+        values = {'r': r, 'g': g, 'b': b, 'w': w, 'd': d}
+        return [values[c] for c in self.channels]
 
-                # Default everything off
-                dmx = [0] * 4
+    def decode(self, values):
+        ''' Set the state from the DMX channel values. The inverse of
+            render(), up to the rounding of the colors scaled by the
+            brightness.
+        '''
+        state = self.state
+        v = dict(zip(self.channels, values))
+        if not any(values):
+            state["state"] = "OFF"
+            return
+        state["state"] = "ON"
 
-                if state["state"] == "ON":
-                    r = int(state["color"]["r"])
-                    g = int(state["color"]["g"])
-                    b = int(state["color"]["b"])
-                    w = int(state["white_value"])
-                    y = int(state["brightness"]) / 255
+        r, g, b = v.get('r', 0), v.get('g', 0), v.get('b', 0)
+        if 'd' in v:
+            state["brightness"] = v['d']
+        elif 'r' in v or 'g' in v or 'b' in v:
+            # Without a dimmer channel the colors are scaled by the
+            # brightness
+            y = max(r, g, b)
+            state["brightness"] = y
+            if y:
+                r, g, b = (round(c * 255 / y) for c in (r, g, b))
+        if "color" in state and (r or g or b):
+            state["color"] = {"r": r, "g": g, "b": b}
+        if "white_value" in state:
+            state["white_value"] = v.get('w', 0)
 
-                    # If brightness is set but no color, set it to pure white
-                    if y > 0 and r == 0 and g == 0 and b == 0:
-                        r = g = b = 255
+    def monitor(self, data, adopt=False):
+        ''' Check the DMX data of the universe for changes of the fixture
+            made by someone else. The changes are decoded into the state,
+            and the own state is restored when the DMX is back to the own
+            frame. With adopt, the changes are also taken into the frame,
+            for LTP setups where the latest value wins. Returns True if the
+            state was changed.
+        '''
+        size = len(self.channels)
+        values = bytes(data[self.address:self.address+size]).ljust(size, b'\0')
 
-                    # RGBW values are hardcoded into DMX channels 0-3
-                    dmx = [int(r * y), int(g * y), int(b * y), w]
+        # Skip the fixtures being faded
+        universe = self.universe
+        if self.address in universe.fades:
+            return False
+        if universe.is_echo(self.address, values):
+            if self.external is None:
+                return False
+            log.debug("    DMX %s/%s back to own", universe.universe, self.address + 1)
+            self.state.update(self.external)
+            self.external = None
+            return True
 
-                # Update the DMX data. Universe 0
-                print(f"    DMX {dmx}")
-                OlaClient().SendDmx(0, Array(dmx), None)
+        log.debug("    DMX %s/%s changed: %s", universe.universe, self.address + 1, list(values))
+        if adopt:
+            universe.adopt(self.address, values)
+        elif self.external is None:
+            self.external = dict(self.state)
+        self.decode(values)
+        return True
 
-                await self.publish_state()
+    def update(self, transition=0, done=None):
+        ''' Write the current state into the universe frame, fading over
+            transition seconds
+        '''
+        values = self.render()
+        log.debug("    DMX %s/%s: %s", self.universe.universe, self.address + 1, values)
+        if transition > 0:
+            self.universe.fade(self.address, values, transition, done)
+        else:
+            self.universe.update(self.address, values)
 
 
-async def main(conf):
-    print(f"{conf['id']}: Running ola device")
+class OlaHatt(hatt.Hatt):
+
+    def __init__(self, conf, hub):
+        super().__init__(conf, hub)
 
-    reconnect = False
-    reconnect_interval = conf['reconnect_interval']
-    while True:
+        # The DMX output is olad, or sACN or Art-Net sent directly. The
+        # olad connection and the UDP senders are shared by all devices in
+        # the process.
+        output = conf.get('output', 'olad')
+        default_universe = 0
+        if output == 'olad':
+            self.ola = olad.get_client(conf.get('olad_host', olad.DEFAULT_HOST),
+                                       conf.get('olad_port', olad.DEFAULT_PORT))
+        else:
+            kwargs = {}
+            if output == 'sacn':
+                kwargs = {
+                    'name': conf.get('output_source', 'hatt'),
+                    'priority': conf.get('output_priority', dmxnet.SACN_PRIORITY),
+                }
+            # sACN universes start at 1
+            default_universe = dmxnet.SENDERS[output].min_universe
+            self.ola = dmxnet.get_sender(
+                output, conf.get('output_host'), conf.get('output_port'),
+                conf.get('output_universes'), conf.get('output_interface'), **kwargs)
+
+        # Without a fixture map, the device itself is one RGBW light on
+        # universe 0 (1 with sACN), address 1-4
+        fixtures = conf.get('fixtures')
+        if fixtures is None:
+            fixtures = {conf['id']: {
+                "topic": conf['topic'],
+                "name": conf['name'],
+                "unique_id": conf['unique_id'],
+                "universe": default_universe,
+                "address": 1,
+                "channels": "rgbw",
+            }}
+
+        self.fixtures = {}
+        self.fade_tasks = set()
+        for fid, fconf in fixtures.items():
+            fconf = dict(fconf)
+            fconf.setdefault('topic', f"{conf['topic']}/{fid}")
+            fconf.setdefault('name', fid)
+            fconf.setdefault('unique_id', f"{conf['unique_id']}_{fid}")
+            fconf.setdefault('universe', default_universe)
+            fixture = Fixture(self, fid, fconf)
+            self.fixtures[fixture.command_topic] = fixture
+
+        conf["config"] = {f.id: f.config for f in self.fixtures.values()}
+
+        # With monitor, the DMX data of the universes is received from olad,
+        # and the changes made by other controllers are published as the
+        # state of the fixtures, at most once per monitor_interval
+        self.monitor = conf.get('monitor', False)
+        if self.monitor and output != 'olad':
+            raise ValueError(f"{conf['id']}: monitor needs the olad output")
+        self.monitor_interval = conf.get('monitor_interval', 0.5)
+        self.monitor_adopt = conf.get('monitor_adopt', False)
+        self.monitor_task = None
+        self.monitor_next = 0
+        self.monitor_changed = set()
+        self.monitored = {}
+        for fixture in self.fixtures.values():
+            self.monitored.setdefault(fixture.universe.universe, []).append(fixture)
+
+    def get_universe(self, universe):
+        ''' Return the output scheduler for a universe '''
+        if isinstance(self.ola, dmxnet.Sender):
+            # Allocate the packet up front, which checks the universe
+            self.ola.packet(universe)
+        return dmx.get_universe(
+            self.ola, universe,
+            fps=self.conf.get('dmx_fps', dmx.DEFAULT_FPS),
+            keepalive=self.conf.get('dmx_keepalive', dmx.DEFAULT_KEEPALIVE),
+        )
+
+    async def main(self):
+        universes = list(self.monitored) if self.monitor else []
+        for universe in universes:
+            self.monitored[universe][0].universe.track_echoes()
+            self.ola.add_listener(universe, self.dmx_received)
         try:
-            if reconnect:
-                await asyncio.sleep(reconnect_interval)
+            await super().main()
+        finally:
+            for universe in universes:
+                self.ola.remove_listener(universe, self.dmx_received)
+            await hatt.cancel_task(self.monitor_task)
+            # The fades go on in the universe, but are no longer reported
+            tasks, self.fade_tasks = self.fade_tasks, None
+            for task in list(tasks):
+                await hatt.cancel_task(task)
+
+    def subscriptions(self):
+        return list(self.fixtures) + [self.HA_STATUS]
+
+    async def handle_message(self, message):
+        await super().handle_message(message)
+
+        fixture = self.fixtures.get(message.topic)
+        if fixture:
+            data = state.loads(message.payload)
+            fixture.command(data)
+            log.debug("    STATE: %s", fixture.state)
 
-            await OlaHatt(conf).main()
+            # Update the DMX frame. The changes of all fixtures in the
+            # universe are sent together by the scheduler
+            transition = float(data.get("transition", 0))
+            if transition > 0:
+                # The state is reported when the fade completes
+                fixture.update(transition, lambda f=fixture: self.faded(f))
+            else:
+                fixture.update()
+                await self.publish_fixture_state(fixture)
 
+    def retained_topics(self):
+        return [f.state_topic for f in self.fixtures.values()] + [self.status_topic]
+
+    def coalesced_topics(self):
+        return list(self.fixtures)
+
+    def merge_messages(self, old, new):
+        # The commands only carry the changed fields, so the newer fields
+        # are merged into the older command
+        try:
+            data = state.loads(old.payload)
+            data.update(state.loads(new.payload))
+        except (ValueError, TypeError, AttributeError):
+            return new
+        new.payload = state.dumps(data)
+        return new
+
+    def configs(self):
+        return [(f.config_topic, f.config) for f in self.fixtures.values()]
+
+    async def publish_state(self, force=False):
+        for fixture in self.fixtures.values():
+            await self.publish_fixture_state(fixture, force)
+
+    def faded(self, fixture):
+        ''' Called by the scheduler when the fade of a fixture is done '''
+        if self.fade_tasks is None:
+            return
+        task = asyncio.create_task(self.publish_faded_state(fixture))
+        self.fade_tasks.add(task)
+        task.add_done_callback(self.fade_tasks.discard)
+
+    async def publish_faded_state(self, fixture):
+        try:
+            await self.publish_fixture_state(fixture)
+        except mqtt.MqttError as error:
+            log.error('Error "%s" publishing %s', error, fixture.state_topic)
+
+    def dmx_received(self, universe, data):
+        ''' Called by the olad client with the DMX data of a universe '''
+        changed = self.monitor_changed
+        for fixture in self.monitored.get(universe, ()):
+            if fixture.monitor(data, self.monitor_adopt):
+                changed.add(fixture)
+        if changed and not self.monitor_task:
+            self.monitor_task = asyncio.create_task(self.publish_monitored())
+
+    async def publish_monitored(self):
+        ''' Publish the states changed by DMX from others. A busy universe
+            is published at most once per monitor_interval.
+        '''
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(self.monitor_next - loop.time())
+        await self.config_event.wait()
+        self.monitor_next = loop.time() + self.monitor_interval
+
+        # Changes from here on are published by the next task
+        self.monitor_task = None
+        changed, self.monitor_changed = self.monitor_changed, set()
+        try:
+            for fixture in changed:
+                # The state of a fade started since is published when done
+                if fixture.address not in fixture.universe.fades:
+                    await self.publish_fixture_state(fixture)
         except mqtt.MqttError as error:
-            print(f'Error "{error}". Reconnecting in {reconnect_interval} seconds.')
-            reconnect = True
+            log.error('Error "%s" publishing the monitored state', error)
+
+    async def publish_fixture_state(self, fixture, force=False):
+        if force or fixture.state.dirty:
+            fixture.state.dirty = False
+            return await self.publish_retained(fixture.state_topic, fixture.state.encode())
+
+
+async def main(conf, hub):
+    log.info("%s: Running ola device", conf['id'])
+
+    await OlaHatt(conf, hub).main()
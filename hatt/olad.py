@@ -0,0 +1,456 @@
+import asyncio
+import logging
+import struct
+
+
+log = logging.getLogger(__name__)
+
+
+# OLA stream RPC protocol
+# Every message is prefixed by a 32-bit native endian header
+#     Bits 31-28: Protocol version (1)
+#     Bits 27-0:  Size of the message
+# The message is a protobuf encoded RpcMessage, which in turn carries the
+# protobuf encoded request or response in its buffer field.
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 9010
+
+PROTOCOL_VERSION = 1
+SIZE_MASK = 0x0FFFFFFF
+HEADER = struct.Struct('<I')
+
+# RpcMessage types
+REQUEST = 1
+RESPONSE = 2
+RESPONSE_CANCEL = 3
+RESPONSE_FAILED = 4
+RESPONSE_NOT_IMPLEMENTED = 5
+DISCONNECT = 6
+
+# RpcMessage fields
+RPC_TYPE = 1
+RPC_ID = 2
+RPC_NAME = 3
+RPC_BUFFER = 4
+
+# DmxData fields
+DMX_UNIVERSE = 1
+DMX_DATA = 2
+DMX_PRIORITY = 3
+
+# UniverseRequest fields
+UNIVERSE_UNIVERSE = 1
+
+# RegisterDmxRequest fields and actions
+REGISTER_UNIVERSE = 1
+REGISTER_ACTION = 2
+REGISTER = 1
+UNREGISTER = 2
+
+DMX_SIZE = 512
+
+
+class OlaError(Exception):
+    pass
+
+
+# -- Minimal protobuf encoding of the few messages in use --
+
+def encode_varint(value):
+    ''' Return value as protobuf varint '''
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def decode_varint(buf, pos):
+    ''' Decode varint at pos. Returns value and the next position '''
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_message(fields):
+    ''' Encode protobuf message from a list of (field, value) pairs. Values
+        of int are encoded as varint, str and bytes as length-delimited.
+    '''
+    out = bytearray()
+    for field, value in fields:
+        if value is None:
+            continue
+        if isinstance(value, int):
+            out += encode_varint(field << 3)
+            out += encode_varint(value)
+        else:
+            if isinstance(value, str):
+                value = value.encode()
+            out += encode_varint(field << 3 | 2)
+            out += encode_varint(len(value))
+            out += value
+    return bytes(out)
+
+
+def decode_message(buf):
+    ''' Decode protobuf message into a dict of field: value '''
+    fields = {}
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = decode_varint(buf, pos)
+        field, wiretype = key >> 3, key & 0x7
+        if wiretype == 0:
+            value, pos = decode_varint(buf, pos)
+        elif wiretype == 2:
+            size, pos = decode_varint(buf, pos)
+            value = bytes(buf[pos:pos+size])
+            pos += size
+        elif wiretype == 1:
+            value = bytes(buf[pos:pos+8])
+            pos += 8
+        elif wiretype == 5:
+            value = bytes(buf[pos:pos+4])
+            pos += 4
+        else:
+            raise OlaError(f"Unsupported wire type {wiretype}")
+        fields[field] = value
+    return fields
+
+
+class RpcProtocol(asyncio.Protocol):
+    ''' OLA stream RPC framing, shared by the client and the fake olad '''
+
+    def __init__(self):
+        self.transport = None
+        self.rxbuffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.rxbuffer = bytearray()
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def data_received(self, data):
+        buf = self.rxbuffer
+        buf += data
+
+        # Process all complete messages in the buffer
+        pos = 0
+        while len(buf) - pos >= HEADER.size:
+            header, = HEADER.unpack_from(buf, pos)
+            size = header & SIZE_MASK
+            start = pos + HEADER.size
+            if len(buf) - start < size:
+                break
+            pos = start + size
+
+            if header >> 28 != PROTOCOL_VERSION:
+                log.error("Unsupported protocol version %s", header >> 28)
+                self.transport.close()
+                return
+
+            msg = decode_message(buf[start:pos])
+            self.rpc_received(
+                msg.get(RPC_TYPE), msg.get(RPC_ID, 0),
+                msg.get(RPC_NAME, b'').decode(), msg.get(RPC_BUFFER, b''),
+            )
+
+        del buf[:pos]
+
+    def rpc_received(self, rpctype, rpcid, name, buffer):
+        pass
+
+    def send_rpc(self, rpctype, rpcid, name=None, buffer=b''):
+        payload = encode_message((
+            (RPC_TYPE, rpctype),
+            (RPC_ID, rpcid),
+            (RPC_NAME, name),
+            (RPC_BUFFER, buffer),
+        ))
+        self.transport.write(
+            HEADER.pack(PROTOCOL_VERSION << 28 | len(payload)) + payload
+        )
+
+
+class OlaClient(RpcProtocol):
+    ''' Persistent asyncio connection to olad. The client reconnects
+        automatically when the connection is lost. Use get_client() to get
+        the shared instance for the process.
+    '''
+    reconnect_interval = 3
+    timeout = 5
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.sequence = 0
+        self.pending = {}
+        self.task = None
+        self.lost = None
+
+        # DMX listeners as {universe: [callback]}
+        self.listeners = {}
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.main())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self.lost = loop.create_future()
+                await loop.create_connection(lambda: self, self.host, self.port)
+                log.info("Connected to olad at %s:%s", self.host, self.port)
+                await self.lost
+                log.warning("Connection to olad lost. Reconnecting in %s seconds.",
+                            self.reconnect_interval)
+            except OSError as error:
+                log.error('Error "%s". Reconnecting in %s seconds.',
+                          error, self.reconnect_interval)
+            await asyncio.sleep(self.reconnect_interval)
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        # The registrations for DMX updates are per connection
+        for universe in self.listeners:
+            self._register(universe, REGISTER)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        for future, timer in self.pending.values():
+            timer.cancel()
+            if not future.done():
+                future.set_exception(OlaError("Connection to olad lost"))
+        self.pending.clear()
+        if self.lost and not self.lost.done():
+            self.lost.set_result(exc)
+
+    @property
+    def connected(self):
+        return self.transport is not None
+
+    def rpc_received(self, rpctype, rpcid, name, buffer):
+        if rpctype == REQUEST:
+            # olad only calls UpdateDmxData of the client, for the
+            # universes registered for DMX
+            if name == "UpdateDmxData":
+                self.dmx_received(decode_message(buffer))
+                self.send_rpc(RESPONSE, rpcid)
+            else:
+                self.send_rpc(RESPONSE_NOT_IMPLEMENTED, rpcid)
+            return
+
+        future, timer = self.pending.pop(rpcid, (None, None))
+        if not future:
+            return
+        timer.cancel()
+        if future.done():
+            return
+        if rpctype == RESPONSE:
+            future.set_result(buffer)
+        elif rpctype == RESPONSE_FAILED:
+            future.set_exception(OlaError(buffer.decode(errors='replace')))
+        elif rpctype == RESPONSE_NOT_IMPLEMENTED:
+            future.set_exception(OlaError("Request not implemented by olad"))
+        else:
+            future.set_exception(OlaError(f"Request failed, response type {rpctype}"))
+
+    def call(self, name, request):
+        ''' Send a RPC request. Returns a future for the response buffer '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.connected:
+            future.set_exception(OlaError("Not connected to olad"))
+            return future
+
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        rpcid = self.sequence
+        timer = loop.call_later(self.timeout, self._timeout, rpcid)
+        self.pending[rpcid] = (future, timer)
+        self.send_rpc(REQUEST, rpcid, name, request)
+        return future
+
+    def _timeout(self, rpcid):
+        future, _ = self.pending.pop(rpcid, (None, None))
+        if future and not future.done():
+            future.set_exception(OlaError("Request to olad timed out"))
+
+    def send_dmx(self, universe, data, priority=None):
+        ''' Send DMX data to a universe. Returns a future for the ack. '''
+        return self.call("UpdateDmxData", encode_message((
+            (DMX_UNIVERSE, universe),
+            (DMX_DATA, bytes(data)),
+            (DMX_PRIORITY, priority),
+        )))
+
+    async def get_dmx(self, universe):
+        ''' Return the current DMX data of a universe '''
+        buffer = await self.call("GetDmx", encode_message((
+            (UNIVERSE_UNIVERSE, universe),
+        )))
+        return decode_message(buffer).get(DMX_DATA, b'')
+
+    def add_listener(self, universe, callback):
+        ''' Call callback(universe, data) with the DMX data of the universe
+            when olad reports a change. The client registers for the DMX of
+            the universe while it has listeners.
+        '''
+        listeners = self.listeners.setdefault(universe, [])
+        listeners.append(callback)
+        if len(listeners) == 1 and self.connected:
+            self._register(universe, REGISTER)
+
+    def remove_listener(self, universe, callback):
+        listeners = self.listeners.get(universe, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        if not listeners and self.listeners.pop(universe, None) is not None and self.connected:
+            self._register(universe, UNREGISTER)
+
+    def _register(self, universe, action):
+        future = self.call("RegisterForDmx", encode_message((
+            (REGISTER_UNIVERSE, universe),
+            (REGISTER_ACTION, action),
+        )))
+        future.add_done_callback(lambda f: self._registered(universe, f))
+
+    def _registered(self, universe, future):
+        if not future.cancelled() and future.exception():
+            log.warning("Failed to register for DMX of universe %s: %s",
+                        universe, future.exception())
+
+    def dmx_received(self, msg):
+        universe = msg.get(DMX_UNIVERSE, 0)
+        data = msg.get(DMX_DATA, b'')
+        for callback in list(self.listeners.get(universe, ())):
+            try:
+                callback(universe, data)
+            except Exception:
+                log.exception("DMX listener of universe %s failed", universe)
+
+
+_clients = {}
+
+
+def get_client(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    ''' Return the process wide client for the given olad '''
+    client = _clients.get((host, port))
+    if not client:
+        client = _clients[(host, port)] = OlaClient(host, port)
+        client.start()
+    return client
+
+
+class FakeOladProtocol(RpcProtocol):
+
+    def __init__(self, olad):
+        super().__init__()
+        self.olad = olad
+        self.sequence = 0
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        for clients in self.olad.registered.values():
+            clients.discard(self)
+
+    def update_dmx(self, universe, data):
+        ''' Send the DMX data of a registered universe to the client '''
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self.send_rpc(REQUEST, self.sequence, "UpdateDmxData", encode_message((
+            (DMX_UNIVERSE, universe),
+            (DMX_DATA, data),
+        )))
+
+    def rpc_received(self, rpctype, rpcid, name, buffer):
+        if rpctype != REQUEST:
+            return
+        method = getattr(self.olad, 'rpc_' + name, None)
+        if not method:
+            self.send_rpc(RESPONSE_NOT_IMPLEMENTED, rpcid)
+            return
+        try:
+            response = method(self, decode_message(buffer))
+        except OlaError as e:
+            self.send_rpc(RESPONSE_FAILED, rpcid, buffer=str(e).encode())
+            return
+        self.send_rpc(RESPONSE, rpcid, buffer=response)
+
+
+class FakeOlad:
+    ''' Local stand-in for olad for testing without DMX hardware. It
+        accepts the same RPC protocol as olad and keeps the DMX data of the
+        universes it receives. Like olad, the data is sent to the clients
+        registered for the DMX of the universe.
+    '''
+
+    def __init__(self):
+        self.server = None
+        self.universes = {}
+        self.registered = {}
+        self.frames = 0
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: FakeOladProtocol(self), host, port)
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def rpc_UpdateDmxData(self, client, request):
+        data = request.get(DMX_DATA, b'')
+        if len(data) > DMX_SIZE:
+            raise OlaError("Too many DMX channels")
+        universe = request.get(DMX_UNIVERSE, 0)
+        self.universes[universe] = data
+        self.frames += 1
+        for registered in self.registered.get(universe, ()):
+            registered.update_dmx(universe, data)
+        return b''
+
+    def rpc_RegisterForDmx(self, client, request):
+        universe = request.get(REGISTER_UNIVERSE, 0)
+        clients = self.registered.setdefault(universe, set())
+        if request.get(REGISTER_ACTION, REGISTER) == REGISTER:
+            clients.add(client)
+        else:
+            clients.discard(client)
+        return b''
+
+    def rpc_GetDmx(self, client, request):
+        universe = request.get(UNIVERSE_UNIVERSE, 0)
+        return encode_message((
+            (DMX_UNIVERSE, universe),
+            (DMX_DATA, self.universes.get(universe, b'')),
+        ))
+
+
+async def _fake_olad(host, port):
+    olad = await FakeOlad().start(host, port)
+    log.info("Fake olad listening on %s:%s", host, port)
+    async with olad.server:
+        await olad.server.serve_forever()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog='hatt.olad', description='Fake olad')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_fake_olad(opts.host, opts.port))
@@ -0,0 +1,162 @@
+import asyncio
+import functools
+import logging
+import signal
+from importlib import import_module
+
+from .hatt import MqttHub, cancel_task
+from . import config
+from . import startup
+
+
+log = logging.getLogger(__name__)
+
+
+async def device_main(data, hub):
+    ''' Import the plugin of the device and run it. The import runs in a
+        thread, so the devices and the broker connection start in parallel
+        with it.
+    '''
+    loop = asyncio.get_running_loop()
+    plugin = await loop.run_in_executor(None, import_module, 'hatt.' + data['module'])
+    startup.mark(data['id'], 'import')
+    await plugin.main(data, hub)
+
+
+class Runner:
+    ''' Runs the devices and their MQTT hubs in this process. The config is
+        reloaded on SIGHUP, or when the file changes with watch_config. A
+        reload only restarts the devices that were added, removed or
+        changed, and an invalid config is rejected without touching the
+        running devices.
+    '''
+
+    def __init__(self, conf, devices, name, source=None):
+        self.conf = conf
+        self.devices = devices
+        self.name = name
+        self.source = source
+
+        # The device and hub configs of the running devices, their tasks,
+        # and the hubs as {key: (hub, task)}
+        self.running = {}
+        self.tasks = {}
+        self.hub_keys = {}
+        self.hubs = {}
+
+        self.lock = None
+        self.reload_task = None
+
+    def _create_task(self, coro, name):
+        task = asyncio.create_task(coro)
+        task.add_done_callback(functools.partial(self._task_done, name))
+        return task
+
+    @staticmethod
+    def _task_done(name, task):
+        if not task.cancelled() and task.exception():
+            log.error("%s stopped", name, exc_info=task.exception())
+
+    def configs(self, conf, devices):
+        ''' Return the device and hub configs of devices '''
+        configs = {}
+        for device in devices:
+            data = config.device_conf(conf, device)
+            configs[device] = (data, config.hub_conf(conf, data, self.name))
+        return configs
+
+    def start_device(self, device, configs):
+        data, (key, hubconf) = configs
+        if key not in self.hubs:
+            hub = MqttHub(hubconf)
+            self.hubs[key] = (hub, self._create_task(hub.main(), hubconf['name']))
+        self.running[device] = configs
+        self.hub_keys[device] = key
+        # The device adds to its config, so it gets a copy
+        self.tasks[device] = self._create_task(
+            device_main(config.device_conf(self.conf, device), self.hubs[key][0]), device)
+
+    async def stop_device(self, device, stop_hub=True):
+        del self.running[device]
+        key = self.hub_keys.pop(device)
+        await cancel_task(self.tasks.pop(device))
+
+        # Stop the hub when its last device is stopped
+        if stop_hub and key not in self.hub_keys.values():
+            await self.stop_hub(key)
+
+    async def stop_hub(self, key):
+        _, task = self.hubs.pop(key)
+        await cancel_task(task)
+
+    async def reload(self):
+        async with self.lock:
+            log.info("Reloading %s", self.source.path)
+            try:
+                conf, devices = self.source.reload(self.conf)
+            except (OSError, ValueError) as e:
+                log.error("Config reload failed. Keeping the running config.\n%s", e)
+                return
+
+            configs = self.configs(conf, devices)
+            removed = [d for d in self.running if d not in configs]
+            changed = [d for d in self.running if d in configs and configs[d] != self.running[d]]
+            added = [d for d in devices if d not in self.running]
+
+            self.conf = conf
+            self.devices = devices
+            # The hubs are kept while the devices are restarted, so the
+            # MQTT connection isn't dropped when a hub's only device changes
+            for device in removed + changed:
+                log.info("Stopping %s", device)
+                await self.stop_device(device, stop_hub=False)
+
+            # Hubs without devices whose settings changed are restarted
+            hubconfs = {key: hubconf for _, (key, hubconf) in configs.values()}
+            used = set(self.hub_keys.values())
+            for key, (hub, _) in list(self.hubs.items()):
+                if key not in used and key in hubconfs and hub.conf != hubconfs[key]:
+                    await self.stop_hub(key)
+
+            for device in devices:
+                if device not in self.running:
+                    log.info("Starting %s", device)
+                    self.start_device(device, configs[device])
+
+            # Stop the hubs no longer used
+            for key in list(self.hubs):
+                if key not in self.hub_keys.values():
+                    await self.stop_hub(key)
+
+            log.info("Config reloaded: %s added, %s removed, %s changed, %s unchanged",
+                     len(added), len(removed), len(changed),
+                     len(devices) - len(added) - len(changed))
+
+    def request_reload(self):
+        if not self.reload_task or self.reload_task.done():
+            self.reload_task = asyncio.create_task(self.reload())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+
+        startup.start(self.devices)
+        for device, configs in self.configs(self.conf, self.devices).items():
+            self.start_device(device, configs)
+
+        watcher = None
+        if self.source:
+            loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+            interval = self.conf.get('watch_config')
+            if interval:
+                watcher = asyncio.create_task(
+                    config.watch(self.source.path, interval, self.reload))
+
+        try:
+            # Run until cancelled
+            await loop.create_future()
+        finally:
+            await cancel_task(watcher)
+            await cancel_task(self.reload_task)
+            for device in list(self.tasks):
+                await self.stop_device(device)
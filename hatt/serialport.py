@@ -0,0 +1,304 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+from . import capture as cap
+from . import metrics
+
+
+log = logging.getLogger(__name__)
+
+REQUESTS = metrics.Counter('hatt_serial_requests_total', 'Serial requests sent', ('port',))
+RETRIES = metrics.Counter('hatt_serial_retries_total', 'Serial requests retried after a timeout', ('port',))
+TIMEOUTS = metrics.Counter('hatt_serial_timeouts_total', 'Serial requests failed by timeout', ('port',))
+
+
+class Request:
+    ''' A queued request. match(frame) returns True for the response frame
+        of the request. Requests without reply are completed when sent.
+    '''
+    __slots__ = ('msg', 'future', 'match', 'reply', 'retries', 'key', 'attempts')
+
+    def __init__(self, msg, future, match, reply, retries, key):
+        self.msg = msg
+        self.future = future
+        self.match = match
+        self.reply = reply
+        self.retries = retries
+        self.key = key
+        self.attempts = 0
+
+
+def any_frame(frame):
+    ''' Response matcher for protocols where any frame is the response '''
+    return True
+
+
+class SerialPort(asyncio.Protocol):
+    ''' Request/response engine for serial devices. Only one request is
+        outstanding at a time. Pending requests are sent in priority order
+        (lowest first), and pending requests with the same key share the
+        same response.
+
+        The received data is split into frames by the codec, which is
+        created by calling codec_factory on each connection. Subclasses set
+        codec_factory, or it is given to the constructor. A codec has
+        feed(data), which returns the list of complete frames. Subclasses implement
+        response(request, frame) to return the result of a response, or to
+        raise an exception for error responses.
+
+        Timeouts are timer callbacks, so idle ports cost nothing. Timed out
+        requests are retried up to retries times, with a backoff doubling
+        from backoff seconds where the port is kept quiet.
+    '''
+    timeout = 3.5
+    retries = 0
+    backoff = 0.1
+
+    # Creates the frame codec of each connection
+    codec_factory = None
+
+    # Default serial port settings of connect()
+    settings = {}
+
+    # Logger of the serial traffic
+    log = log
+
+    @classmethod
+    async def connect(cls, device, capture=None, **kwargs):
+        ''' Open the serial port. kwargs override the port settings. The
+            protocol is created with cls(capture, name=device), so it uses
+            the codec_factory of the class.
+        '''
+        # Imported here, as it's only needed with a real serial port
+        import serial_asyncio
+        loop = asyncio.get_running_loop()
+        settings = dict(cls.settings, **kwargs)
+        return await serial_asyncio.create_serial_connection(
+            loop, lambda: cls(capture, name=device), device, **settings)
+
+    def __init__(self, capture=None, name='serial', codec=None):
+        if codec:
+            self.codec_factory = codec
+        if not self.codec_factory:
+            raise TypeError(f"{type(self).__name__}: No codec")
+        self.name = name
+
+        # Record the serial traffic to a capture file
+        self.capture = cap.CaptureWriter(capture) if capture else None
+
+        self.transport = None
+        self.connected = False
+        self.closed = False
+        self.codec = None
+        self.queue = []
+        self.sequence = itertools.count()
+        self.shared = {}
+        self.current = None
+        self.timer = None
+        self.holdoff = None
+
+        # Statistics
+        self.requests = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.retried = 0
+        self.errors = 0
+        self.txbytes = 0
+        self.rxbytes = 0
+
+    def stats(self):
+        ''' Return the statistics of the port '''
+        return {
+            'requests': self.requests,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+            'retries': self.retried,
+            'errors': self.errors,
+            'txbytes': self.txbytes,
+            'rxbytes': self.rxbytes,
+            'pending': len(self.queue),
+        }
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = True
+        self.codec = self.codec_factory()
+
+    def connection_lost(self, exc):
+        if exc:
+            self.log.warning("%s: Serial port lost: %s", self.name, exc)
+        self.connected = False
+        self.closed = True
+        for handle in (self.timer, self.holdoff):
+            if handle:
+                handle.cancel()
+
+        # Fail the outstanding and pending requests
+        requests = [r for _, _, r in self.queue]
+        if self.current:
+            requests.append(self.current)
+        self.queue.clear()
+        self.current = None
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(ConnectionError("Serial port closed"))
+        if self.capture:
+            self.capture.flush()
+
+    def data_received(self, data):
+        self.rxbytes += len(data)
+        if self.capture:
+            self.capture.write(cap.RX, data)
+        for frame in self.codec.feed(data):
+            self.frame_received(frame)
+
+    def frame_received(self, frame):
+        request = self.current
+        if request and request.match(frame):
+            self.current = None
+            self.timer.cancel()
+            self.responses += 1
+            if not request.future.done():
+                try:
+                    request.future.set_result(self.response(request, frame))
+                except Exception as e:
+                    self.errors += 1
+                    request.future.set_exception(e)
+            self.send_next()
+            return
+        self.unsolicited(frame)
+
+    def response(self, request, frame):
+        ''' Return the result of the response frame of request '''
+        return frame
+
+    def unsolicited(self, frame):
+        ''' Called for the frames that are not the response of a request '''
+        self.log.debug("-IGNORED-")
+
+    def describe(self, msg):
+        ''' Return a printout of a request message '''
+        return ' '.join(f'{b:02x}' for b in msg)
+
+    def send_next(self):
+        # Don't send while a response is pending or in the retry backoff
+        if self.current or self.holdoff or not self.connected:
+            return
+
+        while self.queue:
+            _, _, request = heapq.heappop(self.queue)
+
+            # Skip requests that have been cancelled while waiting
+            if request.future.done():
+                continue
+
+            msg = request.msg
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("     <<<  %s", self.describe(msg))
+            self.transport.write(msg)
+            self.requests += 1
+            self.txbytes += len(msg)
+            if self.capture:
+                self.capture.write(cap.TX, msg)
+            if metrics.enabled:
+                REQUESTS.inc(self.name)
+
+            # Requests without reply proceed to the next request at once
+            if not request.reply:
+                request.future.set_result(None)
+                continue
+
+            # Wait for the response
+            self.current = request
+            self.timer = asyncio.get_running_loop().call_later(
+                self.timeout, self.timeout_expired)
+            return
+
+    def timeout_expired(self):
+        request, self.current = self.current, None
+        if request.future.done():
+            self.send_next()
+            return
+
+        retries = self.retries if request.retries is None else request.retries
+        if request.attempts < retries:
+            # Send the request again first, after the port has been quiet
+            # for the backoff time
+            delay = self.backoff * 2 ** request.attempts
+            request.attempts += 1
+            self.retried += 1
+            if metrics.enabled:
+                RETRIES.inc(self.name)
+            self.log.info("Request %s timed out. Retrying in %s seconds",
+                          self.describe(request.msg), delay)
+            heapq.heappush(self.queue, (float('-inf'), 0, request))
+            self.holdoff = asyncio.get_running_loop().call_later(delay, self._resume)
+            return
+
+        self.timeouts += 1
+        if metrics.enabled:
+            TIMEOUTS.inc(self.name)
+        self.log.warning("Request %s timed out", self.describe(request.msg))
+        request.future.set_exception(TimeoutError())
+        self.send_next()
+
+    def _resume(self):
+        self.holdoff = None
+        self.send_next()
+
+    def request(self, msg, priority=0, match=any_frame, reply=True, retries=None, key=None):
+        ''' Queue a request message. Returns a future for the result of the
+            response. Requests with the same key share the response while
+            pending, and are only cancelled when all their callers are.
+            retries overrides the retries of the port.
+        '''
+        if self.closed:
+            future = asyncio.get_running_loop().create_future()
+            future.set_exception(ConnectionError("Serial port closed"))
+            return future
+
+        if key is not None:
+            shared = self.shared.get(key)
+            if shared:
+                return self._waiter(*shared)
+
+        future = asyncio.get_running_loop().create_future()
+        request = Request(msg, future, match, reply, retries, key)
+        heapq.heappush(self.queue, (priority, next(self.sequence), request))
+
+        if key is not None:
+            shared = self.shared[key] = (future, set())
+            future.add_done_callback(lambda f: self._shared_done(key))
+            self.send_next()
+            return self._waiter(*shared)
+
+        self.send_next()
+        return future
+
+    def _waiter(self, future, waiters):
+        ''' Return the future of one caller of a shared request. The
+            request is cancelled when all its callers have been cancelled.
+        '''
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.add(waiter)
+
+        def done(waiter):
+            waiters.discard(waiter)
+            if waiter.cancelled() and not waiters:
+                future.cancel()
+        waiter.add_done_callback(done)
+        return waiter
+
+    def _shared_done(self, key):
+        future, waiters = self.shared.pop(key)
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if future.cancelled():
+                waiter.cancel()
+            elif future.exception():
+                waiter.set_exception(future.exception())
+            else:
+                waiter.set_result(future.result())
@@ -0,0 +1,67 @@
+import logging
+import sys
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+# The startup timeline is only recorded when enabled, by --startup-profile
+enabled = False
+
+# Startup phases of each device, in the order they normally happen
+#     import:    The plugin module is imported
+#     connect:   The MQTT connection is up
+#     subscribe: The device has subscribed to its topics
+#     state:     The first state is published
+#     config:    The discovery config is published
+#     online:    The device reports that it is available
+PHASES = ('import', 'connect', 'subscribe', 'state', 'config', 'online')
+
+_start = time.perf_counter()
+_devices = []
+_timeline = {}
+_reported = False
+
+
+def start(devices):
+    ''' Start recording the timeline of devices. The times are relative to
+        the call of start().
+    '''
+    global _start, _reported
+    _start = time.perf_counter()
+    _devices[:] = devices
+    _timeline.clear()
+    _reported = False
+
+
+def mark(device, phase):
+    ''' Record the first time device reaches phase. The timeline is printed
+        when all devices are online.
+    '''
+    if not enabled:
+        return
+    phases = _timeline.setdefault(device, {})
+    if phase in phases:
+        return
+    phases[phase] = time.perf_counter() - _start
+    log.debug("%s: Startup %s at %.1f ms", device, phase, phases[phase] * 1000)
+    if phase == 'online' and all('online' in _timeline.get(d, ()) for d in _devices):
+        report()
+
+
+def report(file=None):
+    ''' Print the startup timeline, once '''
+    global _reported
+    if not enabled or _reported or not _devices:
+        return
+    _reported = True
+    file = file or sys.stdout
+    width = max([len(d) for d in _devices] + [6])
+    print("Startup timeline (ms)", file=file)
+    print(f"    {'device':<{width}} " + ' '.join(f"{p:>9}" for p in PHASES), file=file)
+    for device in _devices:
+        phases = _timeline.get(device, {})
+        times = [f"{phases[p] * 1000:9.1f}" if p in phases else f"{'-':>9}" for p in PHASES]
+        print(f"    {device:<{width}} " + ' '.join(times), file=file)
+    file.flush()
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+# JSON backends. dumps() returns the encoded bytes
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+BACKENDS = {
+    'json': (_json_dumps, json.loads),
+}
+
+try:
+    import orjson
+    BACKENDS['orjson'] = (orjson.dumps, orjson.loads)
+except ImportError:
+    pass
+
+dumps, loads = BACKENDS['json']
+
+
+def set_json_backend(name=None):
+    ''' Select the JSON backend. Without a name, or with "auto", the
+        fastest installed backend is used.
+    '''
+    global dumps, loads
+    if not name or name == 'auto':
+        name = 'orjson' if 'orjson' in BACKENDS else 'json'
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend '{name}' is not available")
+    log.debug("Using JSON backend %s", name)
+    dumps, loads = BACKENDS[name]
+
+
+def content_hash(obj):
+    ''' Return a hash of the JSON content of obj, independent of the
+        encoding and key order
+    '''
+    return hashlib.sha256(
+        json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+    ).hexdigest()
+
+
+class State(dict):
+    ''' Dict which tracks if any of its fields have changed, and caches its
+        JSON encoding until the next change. Only assignments of the
+        fields are tracked, so nested values must be replaced, not
+        modified in place.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = True
+        self.encoded = None
+
+    def __setitem__(self, key, value):
+        if key in self and self[key] == value:
+            return
+        super().__setitem__(key, value)
+        self.changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed()
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def changed(self):
+        self.dirty = True
+        self.encoded = None
+
+    def encode(self):
+        ''' Return the JSON encoding of the state '''
+        if self.encoded is None:
+            self.encoded = dumps(self)
+        return self.encoded
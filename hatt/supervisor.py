@@ -0,0 +1,344 @@
+import asyncio
+import collections
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import signal
+
+from . import config
+from . import metrics
+from . import startup
+from .log import setup_logging
+from .state import set_json_backend
+
+
+log = logging.getLogger(__name__)
+
+WORKER_UP = metrics.Gauge('hatt_worker_up', 'Worker process is running and healthy', ('worker',))
+WORKER_RESTARTS = metrics.Counter('hatt_worker_restarts_total', 'Worker process restarts', ('worker',))
+
+# Placement policies
+#     module:  One worker per device module. Devices sharing a process wide
+#              resource, like the olad connection and the DMX universes,
+#              stay in the same process.
+#     spread:  Spread the devices evenly over "workers" processes
+#     isolate: One worker per device
+PLACEMENTS = ('module', 'spread', 'isolate')
+
+
+def place(conf, devices):
+    ''' Return the device groups as {group: [devices]}. The placement is
+        a policy name or an explicit map of {group: [devices]}, where the
+        devices not mentioned get a group each.
+    '''
+    sconf = conf['supervisor']
+    placement = sconf.get('placement', 'module')
+    groups = collections.OrderedDict()
+
+    if isinstance(placement, dict):
+        placed = set()
+        for group, members in placement.items():
+            members = [d for d in members if d in devices]
+            if members:
+                groups[group] = members
+                placed.update(members)
+        for device in devices:
+            if device not in placed:
+                groups[device] = [device]
+
+    elif placement == 'module':
+        for device in devices:
+            groups.setdefault(conf['devices'][device]['module'], []).append(device)
+
+    elif placement == 'spread':
+        workers = min(sconf.get('workers', os.cpu_count() or 1), len(devices))
+        for i, device in enumerate(devices):
+            groups.setdefault(f"worker{i % workers}", []).append(device)
+
+    elif placement == 'isolate':
+        for device in devices:
+            groups[device] = [device]
+
+    else:
+        raise ValueError(f"Unknown placement '{placement}'. Use one of {', '.join(PLACEMENTS)}")
+
+    return groups
+
+
+# -- Worker process --
+
+async def _heartbeat(conn, interval):
+    ''' Report that the event loop is alive, with the metrics '''
+    while True:
+        conn.send(metrics.snapshot() if metrics.enabled else None)
+        await asyncio.sleep(interval)
+
+
+async def _worker(mains, conn, interval):
+    from . import amain
+
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    tasks = [asyncio.create_task(_heartbeat(conn, interval))]
+    if metrics.enabled:
+        tasks.append(asyncio.create_task(metrics.loop_lag_monitor()))
+    try:
+        await amain(mains)
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+def worker_main(conf, devices, name, level, records, conn):
+    ''' Entry point of the worker processes. The log records are sent to
+        the supervisor through the records queue, and the heartbeats over
+        conn.
+    '''
+    from . import create_mains
+
+    # The supervisor stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    setup_logging(dict(conf, log_queue=False), level,
+                  logging.handlers.QueueHandler(records))
+    set_json_backend(conf.get('json_backend'))
+    metrics.enabled = 'metrics' in conf
+    startup.enabled = conf.get('startup_profile', False)
+
+    try:
+        asyncio.run(_worker(create_mains(conf, devices, name), conn,
+                            conf['supervisor'].get('health_interval', 5)))
+    except asyncio.CancelledError:
+        pass
+    finally:
+        startup.report()
+
+
+# -- Supervisor --
+
+class _Forward(logging.Handler):
+    ''' Pass the log records of the workers to the loggers of the supervisor '''
+
+    def handle(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def signature(conf, devices):
+    ''' Return the parts of the config that a worker running devices
+        depends on. The worker is restarted on reloads that change it.
+    '''
+    common = {k: v for k, v in conf.items() if k not in ('devices', 'start')}
+    return devices, common, [config.device_conf(conf, d) for d in devices]
+
+
+class Worker:
+    ''' A worker process running a group of devices. The worker is
+        restarted with exponential backoff when it exits, or when it stops
+        sending heartbeats.
+    '''
+
+    def __init__(self, supervisor, group, devices, conf):
+        self.supervisor = supervisor
+        self.group = group
+        self.devices = devices
+        self.conf = conf
+        self.signature = signature(conf, devices)
+        self.name = f"{supervisor.name}-{group}"
+        self.process = None
+        self.conn = None
+        self.seen = 0
+        self.metrics = None
+        self.restarts = 0
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        sconf = self.conf['supervisor']
+        restart_min = sconf.get('restart_min', 1)
+        restart_max = sconf.get('restart_max', 60)
+        failures = 0
+        while True:
+            started = loop.time()
+            await self.run()
+
+            # The backoff is reset when the worker has been running well
+            if loop.time() - started > restart_max:
+                failures = 0
+            delay = min(restart_min * 2 ** failures, restart_max)
+            failures += 1
+            self.restarts += 1
+            if metrics.enabled:
+                WORKER_RESTARTS.inc(self.group)
+            log.error("Worker %s stopped. Restarting in %s seconds.", self.name, delay)
+            await asyncio.sleep(delay)
+
+    async def run(self):
+        ''' Run the worker process until it exits or fails the health check '''
+        loop = asyncio.get_running_loop()
+        sconf = self.conf['supervisor']
+        timeout = sconf.get('health_timeout', 20)
+
+        ctx = self.supervisor.context
+        self.conn, child = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(
+            target=worker_main, name=self.name, daemon=True,
+            args=(self.conf, self.devices, self.name,
+                  self.supervisor.level, self.supervisor.records, child),
+        )
+        self.process.start()
+        child.close()
+        log.info("Started worker %s (pid %s) with %s",
+                 self.name, self.process.pid, ', '.join(self.devices))
+
+        self.seen = loop.time()
+        loop.add_reader(self.conn.fileno(), self.receive)
+        try:
+            while self.process.is_alive():
+                await asyncio.sleep(1)
+                if loop.time() - self.seen > timeout:
+                    log.error("Worker %s has not responded for %s seconds. Killing it.",
+                              self.name, timeout)
+                    self.process.kill()
+                    break
+        finally:
+            if metrics.enabled:
+                WORKER_UP.set(0, self.group)
+            self.metrics = None
+            loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+            await self.stop()
+
+        log.warning("Worker %s exited with code %s", self.name, self.process.exitcode)
+
+    def receive(self):
+        try:
+            while self.conn.poll():
+                self.metrics = self.conn.recv()
+                self.seen = asyncio.get_running_loop().time()
+                if metrics.enabled:
+                    WORKER_UP.set(1, self.group)
+        except (EOFError, OSError):
+            # The worker has exited
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+
+    async def stop(self, timeout=5):
+        ''' Stop the worker process, and kill it if it does not stop '''
+        process = self.process
+        if not process or process.exitcode is not None:
+            return
+        process.terminate()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, process.join, timeout)
+        if process.exitcode is None:
+            log.error("Worker %s did not stop. Killing it.", self.name)
+            process.kill()
+            await loop.run_in_executor(None, process.join)
+
+
+class Supervisor:
+    ''' Runs groups of devices in worker processes. The log records and
+        metrics of the workers are collected in the supervisor. A config
+        reload restarts the workers whose devices or config changed.
+    '''
+
+    def __init__(self, conf, devices, name, level=None, source=None):
+        self.conf = conf
+        self.name = name
+        self.level = level
+        self.source = source
+        self.context = multiprocessing.get_context('spawn')
+        self.records = self.context.Queue()
+        self.workers = {
+            group: Worker(self, group, members, conf)
+            for group, members in place(conf, devices).items()
+        }
+        self.tasks = {}
+        self.lock = None
+        self.reload_task = None
+
+    def collect_metrics(self):
+        ''' Return the metrics of the supervisor and all workers '''
+        snapshots = [metrics.snapshot()]
+        snapshots += [w.metrics for w in self.workers.values() if w.metrics]
+        return metrics.render(metrics.merge(snapshots))
+
+    def start_worker(self, worker):
+        self.workers[worker.group] = worker
+        self.tasks[worker.group] = asyncio.create_task(worker.main())
+
+    async def stop_worker(self, group):
+        worker = self.workers.pop(group)
+        task = self.tasks.pop(group)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await worker.stop()
+
+    async def reload(self):
+        async with self.lock:
+            log.info("Reloading %s", self.source.path)
+            try:
+                conf, devices = self.source.reload(self.conf)
+            except (OSError, ValueError) as e:
+                log.error("Config reload failed. Keeping the running config.\n%s", e)
+                return
+
+            groups = place(conf, devices)
+            stale = [
+                group for group, worker in self.workers.items()
+                if group not in groups or worker.signature != signature(conf, groups[group])
+            ]
+            self.conf = conf
+            for group in stale:
+                log.info("Stopping worker %s", self.workers[group].name)
+                await self.stop_worker(group)
+            for group, members in groups.items():
+                if group not in self.workers:
+                    self.start_worker(Worker(self, group, members, conf))
+
+            log.info("Config reloaded: %s of %s workers restarted",
+                     len(stale), len(self.workers))
+
+    def request_reload(self):
+        if not self.reload_task or self.reload_task.done():
+            self.reload_task = asyncio.create_task(self.reload())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        self.lock = asyncio.Lock()
+
+        for worker in list(self.workers.values()):
+            self.start_worker(worker)
+
+        mains = []
+        if 'metrics' in self.conf:
+            metrics.enabled = True
+            mains.append(metrics.serve(self.conf['metrics'], self.collect_metrics))
+        if self.source:
+            loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+            interval = self.conf.get('watch_config')
+            if interval:
+                mains.append(config.watch(self.source.path, interval, self.reload))
+
+        tasks = [asyncio.create_task(co) for co in mains]
+        try:
+            # Run until cancelled
+            await asyncio.gather(loop.create_future(), *tasks)
+        finally:
+            if self.reload_task:
+                tasks.append(self.reload_task)
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*[self.stop_worker(group) for group in list(self.workers)])
+
+    def run(self):
+        listener = logging.handlers.QueueListener(self.records, _Forward())
+        listener.start()
+        try:
+            asyncio.run(self.main())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        finally:
+            listener.stop()